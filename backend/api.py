@@ -1,23 +1,62 @@
-from flask import Flask, request, jsonify
-from qdrant_client import QdrantClient
-import spacy
+from flask import Flask, Response, request, jsonify, stream_with_context
+from qdrant_client.models import FieldCondition, Filter, MatchValue, QueryRequest
+from embeddings import criar_embedder
+from qdrant_conexao import QDRANT_MODE, obter_cliente
+from cria_db import criar_db
+from sincroniza_jira import importar_jira, sincronizar
+from jiraxml_exporter import ErroConsultaJira
+from jobs import GerenciadorJobs
+from cache import CacheLRU, GeracaoCompartilhada
+from memoria import ler_memoria
+from coalescedor import CoalescedorLotes
+from lexico import SPARSE_VECTOR_NAME, fundir_rrf, vetor_esparso_consulta
+import threading
+import json
 import re
 import html
 import os
-from werkzeug.utils import secure_filename
 import tempfile
-import shutil
 
 app = Flask(__name__)
 
-QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
-QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "jira")
-EMBEDDING_MODEL = os.getenv("SPACY_MODEL", "pt_core_news_md")
 TOP_K = 4
+# Consultas maiores que isso não tentam a busca por igualdade em text/text_raw
+EXACT_MATCH_MAX_CHARS = int(os.getenv("EXACT_MATCH_MAX_CHARS", 512))
+PADRAO_ISSUE_KEY = re.compile(r"^[A-Za-z][A-Za-z0-9_]*-\d+$")
+# "hybrid": BM25 (vetor esparso) + denso fundidos por RRF; "vector": só denso
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Candidatos pedidos a cada fonte antes da fusão
+HYBRID_CANDIDATOS = int(os.getenv("HYBRID_CANDIDATOS", 20))
+# Janela (ms) e tamanho máximo do lote do coalescedor de consultas do /chat
+CHAT_COALESCE_MS = float(os.getenv("CHAT_COALESCE_MS", 0))
+CHAT_COALESCE_MAX = int(os.getenv("CHAT_COALESCE_MAX", 32))
+# /chat/batch: perguntas por requisição e por query_batch_points enviado ao Qdrant
+CHAT_BATCH_MAX = int(os.getenv("CHAT_BATCH_MAX", 1000))
+CHAT_BATCH_SIZE = int(os.getenv("CHAT_BATCH_SIZE", 64))
+CACHE_MAX_ITENS = int(os.getenv("CACHE_MAX_ITENS", 1024))
+CACHE_TTL_SEGUNDOS = int(os.getenv("CACHE_TTL_SEGUNDOS", 600))
+# Quanto o /import-jira espera o job antes de responder 202 (o frontend desiste em 120s)
+IMPORT_JIRA_ESPERA_SEGUNDOS = float(os.getenv("IMPORT_JIRA_ESPERA_SEGUNDOS", 90))
 
-nlp = spacy.load(EMBEDDING_MODEL)
-client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+embedder = criar_embedder()
+client = obter_cliente()
+jobs = GerenciadorJobs()
+cache_embeddings = CacheLRU(CACHE_MAX_ITENS, CACHE_TTL_SEGUNDOS)
+cache_resultados = CacheLRU(CACHE_MAX_ITENS, CACHE_TTL_SEGUNDOS)
+# Incrementada a cada reindexação; faz parte da chave do cache de resultados.
+# Fica num arquivo, então vale para todos os workers (ver cache.GeracaoCompartilhada)
+contador_geracao = GeracaoCompartilhada(f"geracao-{COLLECTION_NAME}")
+_geracao_lock = threading.Lock()
+
+# {geração: bool} - se a collection tem o vetor esparso; muda só quando reindexa
+_suporte_hibrido = {}
+
+def geracao_colecao():
+    return contador_geracao.atual()
+
+def nova_geracao():
+    contador_geracao.incrementar()
 
 def normalizar_texto(texto):
     texto = html.unescape(texto)
@@ -26,98 +65,235 @@ def normalizar_texto(texto):
     texto = re.sub(r'\s+', ' ', texto)
     return texto.strip().lower()
 
+def extrair_overlap(payload):
+    # Pontos novos guardam só o offset; pontos antigos ainda têm o texto em 'overlap'
+    if 'overlap_end' in payload:
+        return payload.get('text_raw', '')[:payload['overlap_end']]
+    return payload.get('overlap', '')
+
 def embed_text(text):
-    doc = nlp(text)
-    return doc.vector.tolist()
+    vetor = cache_embeddings.obter(text)
+    if vetor is None:
+        vetor = embedder.embed(text).tolist()
+        cache_embeddings.guardar(text, vetor)
+    return vetor
+
+def formatar_chunk(point, com_score=False):
+    chunk = {
+        "id": point.id,
+        "text": point.payload.get('text_raw', ''),
+        "overlap": extrair_overlap(point.payload),
+        "key": point.payload.get('key', '')
+    }
+    if com_score:
+        chunk["score"] = point.score
+    return chunk
+
+def planejar_buscas(query, query_norm):
+    """Lista as buscas exatas que podem dar resultado, na ordem de prioridade.
+
+    A busca por key só é feita quando a consulta tem cara de chave de issue
+    (ex: GMUD-16765) e as buscas por igualdade de texto só em consultas
+    curtas; as demais não teriam como casar e só custariam um filtro.
+    """
+    buscas = []
+    query_limpa = query.strip()
+    if PADRAO_ISSUE_KEY.match(query_limpa):
+        buscas.append(("key", "key", query_limpa.upper()))
+    if query_limpa and len(query_limpa) <= EXACT_MATCH_MAX_CHARS:
+        buscas.append(("text_raw", "text_raw", query_limpa))
+        if query_norm:
+            buscas.append(("text", "text", query_norm))
+    return buscas
+
+def usa_busca_hibrida():
+    if RETRIEVAL_MODE != "hybrid":
+        return False
+    geracao = geracao_colecao()
+    suporte = _suporte_hibrido.get(geracao)
+    if suporte is None:
+        params = client.get_collection(collection_name=COLLECTION_NAME).config.params
+        suporte = registrar_suporte_hibrido(geracao, params)
+    return suporte
+
+def registrar_suporte_hibrido(geracao, params):
+    """Guarda (e retorna) se a collection da geração tem o vetor esparso.
+
+    Quem chama usa o valor retornado: outra thread pode trocar a geração e
+    limpar o dicionário entre o registro e uma nova leitura.
+    """
+    suporte = SPARSE_VECTOR_NAME in (params.sparse_vectors or {})
+    with _geracao_lock:
+        _suporte_hibrido.clear()
+        _suporte_hibrido[geracao] = suporte
+    return suporte
+
+def formatar_hibrido(fundidos):
+    chunks = []
+    for point, score_rrf, scores in fundidos:
+        chunk = formatar_chunk(point)
+        chunk["score"] = score_rrf
+        chunk["scores"] = {"dense": scores.get("dense"), "sparse": scores.get("sparse"), "rrf": score_rrf}
+        chunks.append(chunk)
+    return chunks
+
+def montar_requisicoes(buscas, query_norm, query_vector, hibrido_disponivel):
+    """Monta o query_batch_points da cascata: buscas exatas, densa e (se houver) BM25."""
+    requisicoes = [
+        QueryRequest(
+            query=query_vector,
+            filter=Filter(must=[FieldCondition(key=campo, match=MatchValue(value=valor))]),
+            limit=TOP_K,
+            with_payload=True
+        )
+        for _, campo, valor in buscas
+    ]
+    esparso = vetor_esparso_consulta(query_norm) if hibrido_disponivel else None
+    hibrido = esparso is not None and bool(esparso.indices)
+    limite = HYBRID_CANDIDATOS if hibrido else TOP_K
+    requisicoes.append(QueryRequest(query=query_vector, limit=limite, with_payload=True))
+    if hibrido:
+        requisicoes.append(QueryRequest(
+            query=esparso,
+            using=SPARSE_VECTOR_NAME,
+            limit=limite,
+            with_payload=True
+        ))
+    return requisicoes, hibrido
+
+def interpretar_resultados(buscas, hibrido, resultados):
+    """Escolhe o primeiro modo (na ordem de prioridade) com resultado."""
+    for (modo, _, _), result in zip(buscas, resultados):
+        if result:
+            return [formatar_chunk(point) for point in result], modo
+    densos = resultados[len(buscas)]
+    if hibrido:
+        fundidos = fundir_rrf({"dense": densos, "sparse": resultados[len(buscas) + 1]}, TOP_K)
+        if fundidos:
+            return formatar_hibrido(fundidos), "hybrid"
+    if not densos:
+        return [], "none"
+    return [formatar_chunk(hit, com_score=True) for hit in densos[:TOP_K]], "vector"
+
+def consultar_lote(requisicoes):
+    """Envia as requisições num único query_batch_points; retorna os pontos de cada uma."""
+    respostas = client.query_batch_points(collection_name=COLLECTION_NAME, requests=requisicoes)
+    return [resposta.points for resposta in respostas]
+
+def embed_textos(textos):
+    """Embeddings de vários textos, consultando o cache e embedando só os que faltam em lote."""
+    vetores = [cache_embeddings.obter(texto) for texto in textos]
+    faltando = [i for i, vetor in enumerate(vetores) if vetor is None]
+    if faltando:
+        matriz = embedder.embed_lote([textos[i] for i in faltando])
+        for i, linha in zip(faltando, matriz):
+            vetores[i] = linha.tolist()
+            cache_embeddings.guardar(textos[i], vetores[i])
+    return vetores
+
+def buscar_chunks_lote(queries):
+    """Executa a cascata de várias consultas com um embedding em lote e um único query_batch_points.
+
+    Retorna uma lista de (chunks, mode), na ordem das consultas.
+    """
+    if not queries:
+        return []
+    queries_norm = [normalizar_texto(query) for query in queries]
+    vetores = embed_textos(queries_norm)
+    hibrido_disponivel = usa_busca_hibrida()
+    planos = []
+    requisicoes = []
+    for query, query_norm, query_vector in zip(queries, queries_norm, vetores):
+        buscas = planejar_buscas(query, query_norm)
+        reqs, hibrido = montar_requisicoes(buscas, query_norm, query_vector, hibrido_disponivel)
+        planos.append((buscas, hibrido, len(requisicoes), len(reqs)))
+        requisicoes.extend(reqs)
+    resultados = consultar_lote(requisicoes)
+    return [
+        interpretar_resultados(buscas, hibrido, resultados[inicio:inicio + quantidade])
+        for buscas, hibrido, inicio, quantidade in planos
+    ]
+
+# Consultas simultâneas do /chat são agrupadas num lote só (CHAT_COALESCE_MS=0 desliga)
+coalescedor = CoalescedorLotes(buscar_chunks_lote, CHAT_COALESCE_MS, CHAT_COALESCE_MAX) if CHAT_COALESCE_MS > 0 else None
+
+def buscar_chunks(query):
+    """Executa a cascata key/text_raw/text/vetorial em uma única ida ao Qdrant.
+
+    As buscas exatas planejadas e a busca vetorial vão no mesmo query_batch_points;
+    o primeiro modo (na ordem de prioridade) com resultado é o retornado.
+    No modo híbrido a busca por BM25 vai junto e é fundida com a densa por RRF.
+    Com o coalescedor ligado, a consulta entra no lote das que chegarem junto.
+    """
+    if coalescedor is not None:
+        return coalescedor.enviar(query).result()
+    return buscar_chunks_lote([query])[0]
+
+def chave_cache_chat(query):
+    # A chave usa a consulta sem normalizar porque a busca em text_raw depende dela
+    return (query.strip(), geracao_colecao())
 
 @app.route('/chat', methods=['POST'])
 def chat():
     data = request.get_json()
     query = data.get('question', '')
-    query_norm = normalizar_texto(query)
-    # Busca exata no campo key
-    result = client.scroll(
-        collection_name=COLLECTION_NAME,
-        scroll_filter={
-            "must": [
-                {"key": "key", "match": {"value": query.strip().upper()}},
-            ]
-        },
-        limit=TOP_K
-    )[0]
-    if result:
-        chunks = [
-            {
-                "id": point.id,
-                "text": point.payload.get('text_raw', ''),
-                "overlap": point.payload.get('overlap', ''),
-                "key": point.payload.get('key', '')
-            }
-            for point in result
-        ]
-        return jsonify({"chunks": chunks, "mode": "key"})
-    # Busca exata no campo text_raw
-    result = client.scroll(
-        collection_name=COLLECTION_NAME,
-        scroll_filter={
-            "must": [
-                {"key": "text_raw", "match": {"value": query.strip()}},
-            ]
-        },
-        limit=TOP_K
-    )[0]
-    if result:
-        chunks = [
-            {
-                "id": point.id,
-                "text": point.payload.get('text_raw', ''),
-                "overlap": point.payload.get('overlap', ''),
-                "key": point.payload.get('key', '')
-            }
-            for point in result
-        ]
-        return jsonify({"chunks": chunks, "mode": "text_raw"})
-    # Busca exata no campo text (normalizado)
-    result = client.scroll(
-        collection_name=COLLECTION_NAME,
-        scroll_filter={
-            "must": [
-                {"key": "text", "match": {"value": query_norm}},
-            ]
-        },
-        limit=TOP_K
-    )[0]
-    if result:
-        chunks = [
-            {
-                "id": point.id,
-                "text": point.payload.get('text_raw', ''),
-                "overlap": point.payload.get('overlap', ''),
-                "key": point.payload.get('key', '')
-            }
-            for point in result
-        ]
-        return jsonify({"chunks": chunks, "mode": "text"})
-    # Busca vetorial (fallback)
-    query_vector = embed_text(query_norm)
-    search_result = client.search(
-        collection_name=COLLECTION_NAME,
-        query_vector=query_vector,
-        limit=TOP_K
-    )
-    if not search_result:
-        return jsonify({"chunks": [], "mode": "none"})
-    chunks = [
-        {
-            "id": hit.id,
-            "text": hit.payload.get('text_raw', ''),
-            "overlap": hit.payload.get('overlap', ''),
-            "key": hit.payload.get('key', ''),
-            "score": hit.score
-        }
-        for hit in search_result
-    ]
-    return jsonify({"chunks": chunks, "mode": "vector"})
+    chave = chave_cache_chat(query)
+    resultado = cache_resultados.obter(chave)
+    if resultado is None:
+        resultado = buscar_chunks(query)
+        cache_resultados.guardar(chave, resultado)
+    chunks, mode = resultado
+    return jsonify({"chunks": chunks, "mode": mode})
+
+def buscar_com_cache(queries):
+    """buscar_chunks_lote passando pelo cache de resultados; só as consultas que faltam vão ao Qdrant."""
+    chaves = [chave_cache_chat(query) for query in queries]
+    resultados = [cache_resultados.obter(chave) for chave in chaves]
+    faltando = [i for i, resultado in enumerate(resultados) if resultado is None]
+    if faltando:
+        novos = buscar_chunks_lote([queries[i] for i in faltando])
+        for i, resultado in zip(faltando, novos):
+            resultados[i] = resultado
+            cache_resultados.guardar(chaves[i], resultado)
+    return resultados
+
+def gerar_resultados_lote(queries):
+    """Processa as consultas em sub-lotes de CHAT_BATCH_SIZE, gerando um resultado por consulta."""
+    for inicio in range(0, len(queries), CHAT_BATCH_SIZE):
+        parte = queries[inicio:inicio + CHAT_BATCH_SIZE]
+        for query, (chunks, mode) in zip(parte, buscar_com_cache(parte)):
+            yield {"question": query, "chunks": chunks, "mode": mode}
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    data = request.get_json(silent=True) or {}
+    queries = data.get('questions')
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify({"error": "Informe 'questions' como uma lista de textos"}), 400
+    if len(queries) > CHAT_BATCH_MAX:
+        return jsonify({"error": f"Máximo de {CHAT_BATCH_MAX} perguntas por requisição"}), 400
+    # NDJSON: uma linha por pergunta, enviada assim que o sub-lote dela termina
+    if data.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        linhas = (json.dumps(resultado, ensure_ascii=False) + "\n" for resultado in gerar_resultados_lote(queries))
+        return Response(stream_with_context(linhas), mimetype='application/x-ndjson')
+    return jsonify({"results": list(gerar_resultados_lote(queries))})
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "generation": geracao_colecao(),
+        "embeddings": cache_embeddings.estatisticas(),
+        "results": cache_resultados.estatisticas(),
+        "coalescer": coalescedor.estatisticas() if coalescedor is not None else None
+    })
+
+@app.route('/memory', methods=['GET'])
+def memory():
+    # Memória do worker que atendeu (RSS/PSS/privada/compartilhada, ver memoria.py)
+    try:
+        return jsonify(ler_memoria(os.getpid()))
+    except OSError as e:
+        return jsonify({"error": f"Relatório de memória indisponível: {e}"}), 501
 
 @app.route('/qdrant-data', methods=['GET'])
 def qdrant_data():
@@ -128,7 +304,7 @@ def qdrant_data():
             {
                 "id": point.id,
                 "text": point.payload.get('text_raw', ''),
-                "overlap": point.payload.get('overlap', ''),
+                "overlap": extrair_overlap(point.payload),
                 "key": point.payload.get('key', '')
             }
             for point in points
@@ -140,6 +316,22 @@ def qdrant_data():
             return jsonify({"error": "Nenhuma base encontrada. Carregue um arquivo JIRA.xml para iniciar a base vetorial."}), 404
         return jsonify({"error": f"Erro ao consultar Qdrant: {msg}"}), 404
 
+def reindexar(**kwargs):
+    """Roda o criar_db e invalida o cache de resultados ao terminar."""
+    try:
+        return criar_db(**kwargs)
+    finally:
+        nova_geracao()
+
+def reindexar_upload(arquivo_recebido, xml_path, **kwargs):
+    """Coloca o XML recebido no lugar do JIRA.xml e reindexa.
+
+    Roda dentro do job, com a vaga de ingestão já tomada: ninguém mais está
+    lendo o JIRA.xml quando ele é trocado.
+    """
+    os.replace(arquivo_recebido, xml_path)
+    return reindexar(xml_path=xml_path, **kwargs)
+
 @app.route('/upload-jira', methods=['POST'])
 def upload_jira():
     if 'file' not in request.files:
@@ -147,23 +339,94 @@ def upload_jira():
     file = request.files['file']
     if not file.filename.endswith('.xml'):
         return jsonify({'error': 'Arquivo deve ser .xml'}), 400
-    # Salva arquivo temporariamente
-    temp_dir = tempfile.mkdtemp()
-    temp_path = os.path.join(temp_dir, secure_filename(file.filename))
-    file.save(temp_path)
-    # Substitui o JIRA.xml original
+    # Só uma reindexação por collection de cada vez
+    ativo = jobs.ativo(COLLECTION_NAME)
+    if ativo is not None:
+        return jsonify({'error': 'Já existe uma indexação em andamento', 'job_id': ativo.id}), 409
+    # Cada upload vai para um arquivo só dele, na mesma pasta do JIRA.xml (para o os.replace)
     base_dir = os.path.dirname(os.path.abspath(__file__))
     dest_path = os.path.join(base_dir, 'base', 'JIRA.xml')
-    shutil.copy(temp_path, dest_path)
-    # Reprocessa a base vetorial
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='upload-', suffix='.xml', dir=os.path.dirname(dest_path))
+    os.close(fd)
     try:
-        from cria_db import criar_db
-        criar_db()
-        shutil.rmtree(temp_dir)
-        return jsonify({'status': 'Arquivo processado e base vetorial atualizada com sucesso!'})
-    except Exception as e:
-        shutil.rmtree(temp_dir)
-        return jsonify({'error': str(e)}), 500
+        file.save(temp_path)
+        # Reprocessa a base vetorial em background; o JIRA.xml só é trocado pelo job
+        job, criado = jobs.iniciar(COLLECTION_NAME, reindexar_upload, arquivo_recebido=temp_path, xml_path=dest_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    if not criado:
+        os.remove(temp_path)
+        return jsonify({'error': 'Já existe uma indexação em andamento', 'job_id': job.id if job else None}), 409
+    return jsonify({'status': 'Arquivo recebido, indexação iniciada', 'job_id': job.id}), 202
+
+def sincronizar_jira(**kwargs):
+    """Roda a sincronização incremental e invalida o cache de resultados ao terminar."""
+    try:
+        return sincronizar(**kwargs)
+    finally:
+        nova_geracao()
+
+@app.route('/sync-jira', methods=['POST'])
+def sync_jira():
+    data = request.get_json(silent=True) or {}
+    jql = (data.get('jql_query') or '').strip()
+    if not jql:
+        return jsonify({'error': 'Informe jql_query'}), 400
+    job, criado = jobs.iniciar(COLLECTION_NAME, sincronizar_jira, jql=jql, embedder=embedder,
+                               forcar_reconciliacao=bool(data.get('reconcile')))
+    if not criado:
+        return jsonify({'error': 'Já existe uma indexação em andamento', 'job_id': job.id if job else None}), 409
+    return jsonify({'status': 'Sincronização iniciada', 'job_id': job.id}), 202
+
+def importar_jira_job(**kwargs):
+    """Roda o importar_jira como job e devolve o corpo de resposta do /import-jira."""
+    try:
+        stats = importar_jira(**kwargs)
+    finally:
+        nova_geracao()
+    return {
+        'message': f"{stats['issues']} issues importadas e indexadas",
+        'stats': {
+            'total_issues': stats['total'],
+            'imported_issues': stats['issues'],
+            'chunks_created': stats['chunks'],
+            'chunks_updated': stats['atualizados'],
+            'chunks_removed': stats['removidos']
+        }
+    }
+
+@app.route('/import-jira', methods=['POST'])
+def import_jira():
+    data = request.get_json(silent=True) or {}
+    jql = (data.get('jql_query') or '').strip()
+    if not jql:
+        return jsonify({'error': 'Informe jql_query'}), 400
+    try:
+        max_results = int(data.get('max_results') or 0) or None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_results deve ser um inteiro'}), 400
+    # Ocupa a vaga de ingestão da collection como qualquer outro job
+    job, criado = jobs.iniciar(COLLECTION_NAME, importar_jira_job, jql=jql, max_results=max_results,
+                               issue_type=data.get('issue_type'), embedder=embedder)
+    if not criado:
+        return jsonify({'error': 'Já existe uma indexação em andamento', 'job_id': job.id if job else None}), 409
+    # Importações curtas respondem direto; as longas seguem em background (acompanhar em /jobs/<id>)
+    if not job.concluido.wait(IMPORT_JIRA_ESPERA_SEGUNDOS):
+        return jsonify({'status': 'Importação em andamento', 'job_id': job.id}), 202
+    if job.status == 'error':
+        if isinstance(job.excecao, ErroConsultaJira) and job.excecao.status == 400:
+            return jsonify({'error': job.erro}), 400
+        return jsonify({'error': f'Erro ao importar do JIRA: {job.erro}'}), 500
+    return jsonify(job.resultado)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.obter(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job.para_dict())
 
 # No final do arquivo, antes do if __name__ == "__main__":
 try:
@@ -172,4 +435,7 @@ except ImportError:
     pass
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # O reloader do werkzeug importa este arquivo em dois processos; nos modos
+    # embutidos o primeiro já segura a base (trava do QDRANT_PATH) e o que
+    # atende as requisições não consegue abri-la
+    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=QDRANT_MODE == "server")
@@ -0,0 +1,135 @@
+"""
+Modo de produção (ASGI) da API de busca.
+
+/chat e /chatgpt-rank rodam num app Quart assíncrono: a busca usa o
+AsyncQdrantClient, o embedding spaCy roda num pool de threads limitado e a
+OpenAI é chamada com o cliente assíncrono, então um processo atende muitas
+requisições simultâneas. As demais rotas continuam no app Flask (api.py),
+servidas pelo mesmo processo pelo WSGIMiddleware do a2wsgi, que roda cada
+requisição num pool de WSGI_THREADS threads (o WsgiToAsgi do asgiref usa
+uma thread só e enfileiraria /ask, /upload-jira, /import-jira, /jobs...).
+Rotas e respostas são as mesmas do api.py.
+
+Para rodar:
+    uvicorn api_async:asgi_app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from a2wsgi import WSGIMiddleware
+from quart import Quart, request, jsonify
+import api
+from api import (
+    COLLECTION_NAME, RETRIEVAL_MODE, cache_resultados, chave_cache_chat, embed_text,
+    interpretar_resultados, montar_requisicoes, normalizar_texto, planejar_buscas,
+    registrar_suporte_hibrido
+)
+from chatgpt_api import (
+    logger, montar_resposta_rank, preparar_rank, ranquear_async, validar_requisicao_rank
+)
+from qdrant_conexao import criar_cliente_async
+
+# Threads para o spaCy (e para o cliente síncrono nos modos embutidos do Qdrant)
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", 4))
+# Requisições simultâneas nas rotas Flask (o /import-jira pode segurar uma por até 90s)
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 32))
+
+app_async = Quart(__name__)
+executor = ThreadPoolExecutor(max_workers=EMBED_THREADS, thread_name_prefix="embed")
+_cliente_async = None
+
+
+def obter_cliente_async():
+    # Criado sob demanda, já dentro do event loop do servidor
+    global _cliente_async
+    if _cliente_async is None:
+        _cliente_async = criar_cliente_async()
+    return _cliente_async
+
+
+async def em_thread(funcao, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, funcao, *args)
+
+
+async def consultar_lote(requisicoes):
+    cliente = obter_cliente_async()
+    if cliente is None:
+        return await em_thread(api.consultar_lote, requisicoes)
+    respostas = await cliente.query_batch_points(collection_name=COLLECTION_NAME, requests=requisicoes)
+    return [resposta.points for resposta in respostas]
+
+
+async def usa_busca_hibrida():
+    if RETRIEVAL_MODE != "hybrid":
+        return False
+    cliente = obter_cliente_async()
+    if cliente is None:
+        return await em_thread(api.usa_busca_hibrida)
+    geracao = api.geracao_colecao()
+    suporte = api._suporte_hibrido.get(geracao)
+    if suporte is None:
+        info = await cliente.get_collection(collection_name=COLLECTION_NAME)
+        suporte = registrar_suporte_hibrido(geracao, info.config.params)
+    return suporte
+
+
+async def buscar_chunks(query):
+    """Mesma cascata do api.buscar_chunks, sem bloquear o event loop."""
+    if api.coalescedor is not None:
+        # Entra no lote do coalescedor sem ocupar uma thread enquanto espera
+        return await asyncio.wrap_future(api.coalescedor.enviar(query))
+    query_norm = normalizar_texto(query)
+    buscas = planejar_buscas(query, query_norm)
+    query_vector, hibrido_disponivel = await asyncio.gather(
+        em_thread(embed_text, query_norm),
+        usa_busca_hibrida()
+    )
+    requisicoes, hibrido = montar_requisicoes(buscas, query_norm, query_vector, hibrido_disponivel)
+    return interpretar_resultados(buscas, hibrido, await consultar_lote(requisicoes))
+
+
+@app_async.route('/chat', methods=['POST'])
+async def chat():
+    data = await request.get_json()
+    query = data.get('question', '')
+    chave = chave_cache_chat(query)
+    resultado = cache_resultados.obter(chave)
+    if resultado is None:
+        resultado = await buscar_chunks(query)
+        cache_resultados.guardar(chave, resultado)
+    chunks, mode = resultado
+    return jsonify({"chunks": chunks, "mode": mode})
+
+
+@app_async.route('/chatgpt-rank', methods=['POST'])
+async def chatgpt_rank():
+    try:
+        logger.info("Recebida requisição para /chatgpt-rank")
+        data = await request.get_json()
+        question, chunks, erro = validar_requisicao_rank(data)
+        if erro:
+            return jsonify({'error': erro}), 400
+        resposta_local, erro = preparar_rank(question, chunks, data.get('mode'))
+        if erro:
+            return jsonify({'error': erro}), 400
+        if resposta_local:
+            return jsonify(resposta_local)
+
+        resposta_openai = await ranquear_async(question, chunks)
+        return jsonify(montar_resposta_rank(resposta_openai, chunks))
+
+    except Exception as e:
+        logger.error(f"Erro interno: {e}")
+        return jsonify({'error': 'Erro interno do servidor'}), 500
+
+
+# Rotas atendidas pelo app assíncrono; o resto vai para o Flask
+ROTAS_ASYNC = {'/chat', '/chatgpt-rank'}
+_flask_asgi = WSGIMiddleware(api.app, workers=WSGI_THREADS)
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] not in ROTAS_ASYNC:
+        await _flask_asgi(scope, receive, send)
+    else:
+        await app_async(scope, receive, send)
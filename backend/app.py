@@ -1,21 +1,18 @@
 
 import os
-from qdrant_client import QdrantClient
+from qdrant_conexao import obter_cliente
+from embeddings import criar_embedder
 
-import spacy
 import re
 import html
 
 # Configurações
-QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
-QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "jira")
-EMBEDDING_MODEL = os.getenv("SPACY_MODEL", "pt_core_news_md")
 TOP_K = 4
 
 # Carrega spaCy (offline)
 
-nlp = spacy.load(EMBEDDING_MODEL)
+embedder = criar_embedder()
 
 # Função de normalização igual à do cria_db.py
 def normalizar_texto(texto):
@@ -26,11 +23,10 @@ def normalizar_texto(texto):
     return texto.strip().lower()
 
 # Conecta ao Qdrant
-client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+client = obter_cliente()
 
 def embed_text(text):
-    doc = nlp(text)
-    return doc.vector.tolist()
+    return embedder.embed(text).tolist()
 
 def buscar_chunks(query):
     # Busca exata (normalizada) no campo text_raw e text
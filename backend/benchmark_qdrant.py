@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark REST x gRPC do Qdrant: latência das buscas do /chat e vazão de upsert em massa
+"""
+import argparse
+import statistics
+import time
+import numpy as np
+from qdrant_client.models import Batch, QueryRequest, VectorParams
+from qdrant_conexao import criar_cliente
+
+COLLECTION_BENCH = "bench_transporte"
+
+
+def medir_upsert(client, vetores, batch_size):
+    """Envia os vetores em lotes (wait=True) e retorna pontos/s."""
+    inicio = time.perf_counter()
+    for offset in range(0, len(vetores), batch_size):
+        lote = vetores[offset:offset + batch_size]
+        client.upsert(
+            collection_name=COLLECTION_BENCH,
+            points=Batch(
+                ids=list(range(offset, offset + len(lote))),
+                vectors=lote.tolist(),
+                payloads=[{"text_raw": f"chunk {offset + i}"} for i in range(len(lote))]
+            ),
+            wait=True
+        )
+    return len(vetores) / (time.perf_counter() - inicio)
+
+
+def medir_buscas(client, consultas, top_k):
+    """Uma ida ao Qdrant por consulta, no mesmo formato do /chat. Retorna latências em ms."""
+    latencias = []
+    for consulta in consultas:
+        inicio = time.perf_counter()
+        client.query_batch_points(
+            collection_name=COLLECTION_BENCH,
+            requests=[QueryRequest(query=consulta.tolist(), limit=top_k, with_payload=True)]
+        )
+        latencias.append((time.perf_counter() - inicio) * 1000)
+    return latencias
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p), len(ordenados) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara REST e gRPC no Qdrant (upsert em massa e buscas do /chat)')
+    parser.add_argument('--pontos', type=int, default=20000, help='Pontos enviados no teste de upsert (padrão: 20000)')
+    parser.add_argument('--dim', type=int, default=300, help='Dimensão dos vetores (padrão: 300, igual ao pt_core_news_md)')
+    parser.add_argument('--batch-size', type=int, default=256, help='Tamanho do lote de upsert (padrão: 256)')
+    parser.add_argument('--consultas', type=int, default=500, help='Número de buscas medidas (padrão: 500)')
+    parser.add_argument('--top-k', type=int, default=4, help='Resultados por busca (padrão: 4)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    vetores = rng.standard_normal((args.pontos, args.dim), dtype=np.float32)
+    consultas = rng.standard_normal((args.consultas, args.dim), dtype=np.float32)
+
+    resultados = {}
+    for nome, prefer_grpc in (("REST", False), ("gRPC", True)):
+        client = criar_cliente(modo="server", prefer_grpc=prefer_grpc)
+        if client.collection_exists(collection_name=COLLECTION_BENCH):
+            client.delete_collection(collection_name=COLLECTION_BENCH)
+        client.create_collection(
+            collection_name=COLLECTION_BENCH,
+            vectors_config=VectorParams(size=args.dim, distance="Cosine")
+        )
+        try:
+            vazao = medir_upsert(client, vetores, args.batch_size)
+            medir_buscas(client, consultas[:20], args.top_k)  # aquecimento
+            latencias = medir_buscas(client, consultas, args.top_k)
+        finally:
+            client.delete_collection(collection_name=COLLECTION_BENCH)
+            client.close()
+        resultados[nome] = {
+            "upsert_pontos_s": vazao,
+            "busca_p50_ms": statistics.median(latencias),
+            "busca_p95_ms": percentil(latencias, 0.95),
+            "buscas_s": len(latencias) / (sum(latencias) / 1000)
+        }
+
+    print(f"\n{'Transporte':<12}{'upsert (pts/s)':>16}{'busca p50 (ms)':>16}{'busca p95 (ms)':>16}{'buscas/s':>12}")
+    for nome, r in resultados.items():
+        print(f"{nome:<12}{r['upsert_pontos_s']:>16.0f}{r['busca_p50_ms']:>16.2f}{r['busca_p95_ms']:>16.2f}{r['buscas_s']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from travas import TravaArquivo, caminho_estado
+
+_AUSENTE = object()
+
+
+class CacheLRU:
+    """Cache em memória com limite de itens (LRU) e expiração por TTL."""
+
+    def __init__(self, max_itens=1024, ttl=600):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave, padrao=None):
+        with self._lock:
+            item = self._dados.get(chave, _AUSENTE)
+            if item is not _AUSENTE:
+                valor, expira_em = item
+                if expira_em > time.monotonic():
+                    self._dados.move_to_end(chave)
+                    self.hits += 1
+                    return valor
+                del self._dados[chave]
+            self.misses += 1
+            return padrao
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._dados[chave] = (valor, time.monotonic() + self.ttl)
+            self._dados.move_to_end(chave)
+            while len(self._dados) > self.max_itens:
+                self._dados.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self._dados.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._dados),
+                "max_size": self.max_itens,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+class ChamadaUnica:
+    """Single-flight: chamadas simultâneas com a mesma chave compartilham um resultado.
+
+    `iniciar(chave)` retorna (futuro, lider). Só o líder executa a chamada e
+    depois chama `concluir`/`falhar`; os demais apenas esperam o futuro.
+    """
+
+    def __init__(self):
+        self.coalescidas = 0
+        self._em_andamento = {}
+        self._lock = threading.Lock()
+
+    def iniciar(self, chave):
+        with self._lock:
+            futuro = self._em_andamento.get(chave)
+            if futuro is not None:
+                self.coalescidas += 1
+                return futuro, False
+            futuro = Future()
+            # Em execução desde já: um seguidor asyncio cancelado (asyncio.wrap_future
+            # propaga o cancelamento) não consegue cancelar o futuro dos demais
+            futuro.set_running_or_notify_cancel()
+            self._em_andamento[chave] = futuro
+            return futuro, True
+
+    def concluir(self, chave, resultado):
+        with self._lock:
+            futuro = self._em_andamento.pop(chave)
+        futuro.set_result(resultado)
+
+    def falhar(self, chave, erro):
+        with self._lock:
+            futuro = self._em_andamento.pop(chave)
+        futuro.set_exception(erro)
+
+
+class GeracaoCompartilhada:
+    """Contador de geração guardado num arquivo, o mesmo para todos os processos.
+
+    Entra na chave dos caches: quando qualquer processo incrementa (depois
+    de uma reindexação), os outros passam a usar chaves novas na próxima
+    consulta. `atual()` custa um stat e só relê o arquivo quando ele muda.
+    """
+
+    def __init__(self, nome):
+        self.nome = nome
+        self._trava = TravaArquivo(nome)
+        self._lock = threading.Lock()
+        self._assinatura = None
+        self._valor = 0
+
+    def atual(self):
+        try:
+            info = os.stat(caminho_estado(self.nome))
+        except FileNotFoundError:
+            return 0
+        assinatura = (info.st_ino, info.st_mtime_ns, info.st_size)
+        with self._lock:
+            if assinatura != self._assinatura:
+                with open(caminho_estado(self.nome)) as f:
+                    self._valor = int(f.read().strip() or 0)
+                self._assinatura = assinatura
+            return self._valor
+
+    def incrementar(self):
+        # Trava entre processos para não perder incrementos; o os.replace troca
+        # o inode, então os leitores nunca veem o arquivo pela metade
+        with self._trava:
+            valor = self.atual() + 1
+            caminho = caminho_estado(self.nome)
+            temporario = f"{caminho}.{os.getpid()}.tmp"
+            with open(temporario, "w") as f:
+                f.write(str(valor))
+            os.replace(temporario, caminho)
+        return valor
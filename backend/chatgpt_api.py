@@ -1,12 +1,33 @@
 import openai
 import os
 import re
-from flask import request, jsonify, current_app
-from api import app
+import json
+from flask import Response, request, jsonify, current_app, stream_with_context
+import hashlib
+import threading
+import asyncio
+from api import app, buscar_com_cache, normalizar_texto
+from cache import CacheLRU, ChamadaUnica
+from lexico import RRF_K
 import logging
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
+RERANK_CACHE_MAX_ITENS = int(os.getenv("RERANK_CACHE_MAX_ITENS", 2048))
+RERANK_CACHE_TTL_SEGUNDOS = int(os.getenv("RERANK_CACHE_TTL_SEGUNDOS", 3600))
+# Preço (US$) por 1k tokens, só para estimar o custo evitado pelo cache
+OPENAI_PRECO_1K_TOKENS = float(os.getenv("OPENAI_PRECO_1K_TOKENS", 0.0015))
+
+# Gating: dispensa o LLM quando a busca já é confiável (modo exato ou score/margem altos)
+RERANK_GATING = os.getenv("RERANK_GATING", "1") == "1"
+GATE_MODOS_EXATOS = set(os.getenv("GATE_MODOS_EXATOS", "key,text_raw,text").split(","))
+GATE_SCORE_MIN = float(os.getenv("GATE_SCORE_MIN", 0.85))
+GATE_MARGEM_MIN = float(os.getenv("GATE_MARGEM_MIN", 0.08))
+
+cache_rerank = CacheLRU(RERANK_CACHE_MAX_ITENS, RERANK_CACHE_TTL_SEGUNDOS)
+chamadas_rerank = ChamadaUnica()
+_tokens_evitados = 0
+_tokens_lock = threading.Lock()
 
 # Configura logger
 logger = logging.getLogger("chatgpt_api")
@@ -60,16 +81,19 @@ def extrair_numero_chunk(resposta_openai):
         
     return None
 
+def _parametros_openai(prompt):
+    return dict(
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=150,
+        temperature=0.1,  # Pouca criatividade, mais focado
+        timeout=30  # Timeout para evitar bloqueios
+    )
+
 def consultar_openai(prompt):
     logger.info("Enviando prompt para OpenAI")
     try:
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=150,
-            temperature=0.1,  # Pouca criatividade, mais focado
-            timeout=30  # Timeout para evitar bloqueios
-        )
+        response = openai.chat.completions.create(**_parametros_openai(prompt))
         resposta = response.choices[0].message.content.strip()
         logger.info(f"Resposta OpenAI: {resposta}")
         return resposta
@@ -77,52 +101,262 @@ def consultar_openai(prompt):
         logger.error(f"Erro na API OpenAI: {e}")
         raise
 
+_cliente_openai_async = None
+
+async def consultar_openai_async(prompt):
+    """Versão assíncrona do consultar_openai, usada pelo modo ASGI (api_async.py)."""
+    global _cliente_openai_async
+    if _cliente_openai_async is None:
+        _cliente_openai_async = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    logger.info("Enviando prompt para OpenAI (async)")
+    try:
+        response = await _cliente_openai_async.chat.completions.create(**_parametros_openai(prompt))
+        resposta = response.choices[0].message.content.strip()
+        logger.info(f"Resposta OpenAI: {resposta}")
+        return resposta
+    except Exception as e:
+        logger.error(f"Erro na API OpenAI: {e}")
+        raise
+
+def chave_rerank(question, chunks):
+    """Pergunta normalizada + hash do trecho de cada chunk que entra no prompt."""
+    hashes = tuple(
+        hashlib.sha1(chunk.get('text', '')[:500].encode('utf-8')).hexdigest()
+        for chunk in chunks
+    )
+    return (normalizar_texto(question), hashes)
+
+def _registrar_economia(prompt, resposta):
+    # Estimativa grosseira: ~4 caracteres por token
+    global _tokens_evitados
+    with _tokens_lock:
+        _tokens_evitados += (len(prompt) + len(resposta)) // 4
+
+def ranquear(question, chunks):
+    """consultar_openai com cache e single-flight por (pergunta, chunks)."""
+    chave = chave_rerank(question, chunks)
+    prompt = montar_prompt(question, chunks)
+    resposta = cache_rerank.obter(chave)
+    if resposta is not None:
+        _registrar_economia(prompt, resposta)
+        return resposta
+    futuro, lider = chamadas_rerank.iniciar(chave)
+    if not lider:
+        resposta = futuro.result()
+        _registrar_economia(prompt, resposta)
+        return resposta
+    # O líder anterior pode ter terminado entre a consulta ao cache e o iniciar
+    resposta = cache_rerank.obter(chave)
+    if resposta is not None:
+        chamadas_rerank.concluir(chave, resposta)
+        _registrar_economia(prompt, resposta)
+        return resposta
+    try:
+        resposta = consultar_openai(prompt)
+    except BaseException as e:
+        # Qualquer saída (inclusive BaseException) precisa liberar quem espera a chave
+        chamadas_rerank.falhar(chave, e)
+        raise
+    cache_rerank.guardar(chave, resposta)
+    chamadas_rerank.concluir(chave, resposta)
+    return resposta
+
+async def ranquear_async(question, chunks):
+    """Versão assíncrona do ranquear; quem espera não ocupa thread."""
+    chave = chave_rerank(question, chunks)
+    prompt = montar_prompt(question, chunks)
+    resposta = cache_rerank.obter(chave)
+    if resposta is not None:
+        _registrar_economia(prompt, resposta)
+        return resposta
+    futuro, lider = chamadas_rerank.iniciar(chave)
+    if not lider:
+        resposta = await asyncio.wrap_future(futuro)
+        _registrar_economia(prompt, resposta)
+        return resposta
+    # O líder anterior pode ter terminado entre a consulta ao cache e o iniciar
+    resposta = cache_rerank.obter(chave)
+    if resposta is not None:
+        chamadas_rerank.concluir(chave, resposta)
+        _registrar_economia(prompt, resposta)
+        return resposta
+
+    def finalizar(tarefa):
+        # Roda quando a chamada termina, mesmo que o handler do líder tenha sido
+        # cancelado (cliente desconectou): quem espera a chave sempre é liberado
+        if tarefa.cancelled():
+            chamadas_rerank.falhar(chave, RuntimeError("Chamada à OpenAI cancelada"))
+        elif tarefa.exception() is not None:
+            chamadas_rerank.falhar(chave, tarefa.exception())
+        else:
+            cache_rerank.guardar(chave, tarefa.result())
+            chamadas_rerank.concluir(chave, tarefa.result())
+
+    tarefa = asyncio.ensure_future(consultar_openai_async(prompt))
+    tarefa.add_done_callback(finalizar)
+    # O shield impede que o cancelamento do handler cancele a chamada compartilhada
+    return await asyncio.shield(tarefa)
+
+def validar_requisicao_rank(data):
+    """Valida o corpo do /chatgpt-rank. Retorna (question, chunks, erro)."""
+    if not data:
+        return None, None, 'Dados JSON ausentes'
+
+    question = data.get('question', '').strip()
+    chunks = data.get('chunks', [])
+
+    logger.info(f"Pergunta: {question}")
+    logger.info(f"Quantidade de chunks: {len(chunks)}")
+
+    if not question:
+        logger.warning("Pergunta ausente na requisição!")
+        return None, None, 'Pergunta é obrigatória'
+
+    if not chunks:
+        logger.warning("Quantidade insuficiente de chunks!")
+        return None, None, 'São necessários 4 chunks'
+
+    return question, chunks, None
+
+def decidir_gating(chunks, mode):
+    """Decide se a busca já é confiável o bastante para dispensar o LLM.
+
+    Retorna o motivo (texto) quando o chunk 1 pode ser escolhido localmente,
+    ou None quando o rerank pela OpenAI é necessário.
+    """
+    if not RERANK_GATING or not chunks:
+        return None
+    if mode in GATE_MODOS_EXATOS:
+        return f"correspondência exata no modo '{mode}'"
+    if mode == "vector" and chunks[0].get('score') is not None:
+        primeiro = chunks[0]['score']
+        segundo = chunks[1].get('score', 0.0) if len(chunks) > 1 else 0.0
+        if primeiro >= GATE_SCORE_MIN and primeiro - segundo >= GATE_MARGEM_MIN:
+            return f"score {primeiro:.3f} com margem {primeiro - segundo:.3f} sobre o segundo"
+    if mode == "hybrid" and chunks[0].get('scores'):
+        # Primeiro lugar tanto na busca densa quanto na BM25
+        if chunks[0]['scores'].get('rrf', 0.0) >= 2 / (RRF_K + 1) - 1e-9:
+            return "primeiro lugar nas buscas densa e BM25"
+    return None
+
+def preparar_rank(question, chunks, mode):
+    """Aplica o gating antes do LLM. Retorna (resposta_local, erro); ambos None = consultar o LLM."""
+    motivo = decidir_gating(chunks, mode)
+    if motivo:
+        logger.info(f"Gating: LLM dispensado para '{question}' ({motivo})")
+        resposta = montar_resposta_rank(f"Chunk 1 - seleção automática: {motivo}", chunks)
+        resposta['llm'] = False
+        return resposta, None
+    logger.info(f"Gating: LLM necessário para '{question}' (modo '{mode}')")
+    if len(chunks) < 4:
+        logger.warning("Quantidade insuficiente de chunks!")
+        return None, 'São necessários 4 chunks'
+    return None, None
+
+def montar_resposta_rank(resposta_openai, chunks):
+    """Monta a resposta do /chatgpt-rank a partir do texto devolvido pela OpenAI."""
+    # Extrai o número do chunk selecionado
+    numero_chunk = extrair_numero_chunk(resposta_openai)
+
+    # Prepara a resposta para o frontend
+    resposta_final = {
+        'analise': resposta_openai,
+        'chunk_selecionado': None,
+        'texto_chunk': None
+    }
+
+    # Se um chunk foi selecionado, adiciona suas informações
+    if numero_chunk and 1 <= numero_chunk <= len(chunks):
+        chunk_escolhido = chunks[numero_chunk - 1]  # -1 porque os arrays começam em 0
+        resposta_final['chunk_selecionado'] = numero_chunk
+        resposta_final['texto_chunk'] = chunk_escolhido.get('text', '')
+        resposta_final['metadata'] = chunk_escolhido.get('metadata', {})
+
+    logger.info(f"Resposta final para frontend: Chunk {numero_chunk} selecionado")
+    return resposta_final
+
 @app.route('/chatgpt-rank', methods=['POST'])
 def chatgpt_rank():
     try:
         logger.info("Recebida requisição para /chatgpt-rank")
         data = request.get_json()
-        
-        if not data:
-            return jsonify({'error': 'Dados JSON ausentes'}), 400
-            
-        question = data.get('question', '').strip()
-        chunks = data.get('chunks', [])
-        
-        logger.info(f"Pergunta: {question}")
-        logger.info(f"Quantidade de chunks: {len(chunks)}")
-        
-        if not question:
-            logger.warning("Pergunta ausente na requisição!")
-            return jsonify({'error': 'Pergunta é obrigatória'}), 400
-            
-        if not chunks or len(chunks) < 4:
-            logger.warning("Quantidade insuficiente de chunks!")
-            return jsonify({'error': 'São necessários 4 chunks'}), 400
-
-        prompt = montar_prompt(question, chunks)
-        resposta_openai = consultar_openai(prompt)
-        
-        # Extrai o número do chunk selecionado
-        numero_chunk = extrair_numero_chunk(resposta_openai)
-        
-        # Prepara a resposta para o frontend
-        resposta_final = {
-            'analise': resposta_openai,
-            'chunk_selecionado': None,
-            'texto_chunk': None
-        }
-        
-        # Se um chunk foi selecionado, adiciona suas informações
-        if numero_chunk and 1 <= numero_chunk <= len(chunks):
-            chunk_escolhido = chunks[numero_chunk - 1]  # -1 porque os arrays começam em 0
-            resposta_final['chunk_selecionado'] = numero_chunk
-            resposta_final['texto_chunk'] = chunk_escolhido.get('text', '')
-            resposta_final['metadata'] = chunk_escolhido.get('metadata', {})
-        
-        logger.info(f"Resposta final para frontend: Chunk {numero_chunk} selecionado")
-        return jsonify(resposta_final)
-        
+        question, chunks, erro = validar_requisicao_rank(data)
+        if erro:
+            return jsonify({'error': erro}), 400
+        resposta_local, erro = preparar_rank(question, chunks, data.get('mode'))
+        if erro:
+            return jsonify({'error': erro}), 400
+        if resposta_local:
+            return jsonify(resposta_local)
+
+        resposta_openai = ranquear(question, chunks)
+        return jsonify(montar_resposta_rank(resposta_openai, chunks))
+
     except Exception as e:
         logger.error(f"Erro interno: {e}")
-        return jsonify({'error': 'Erro interno do servidor'}), 500
\ No newline at end of file
+        return jsonify({'error': 'Erro interno do servidor'}), 500
+
+def evento_sse(evento, dados):
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+def gerar_eventos_ask(question):
+    """Busca e rerank no servidor, emitindo cada etapa como evento SSE.
+
+    Primeiro vai o evento 'chunks' (resultado da busca, igual ao /chat) e
+    depois o 'verdict' com a escolha do LLM, que referencia o chunk pelo
+    número e pelo id em vez de reenviar o texto.
+    """
+    # Os cabeçalhos (200) já foram enviados: erros viram evento, não status HTTP
+    try:
+        chunks, mode = buscar_com_cache([question])[0]
+    except Exception as e:
+        logger.error(f"Erro na busca do /ask: {e}")
+        yield evento_sse("error", {'error': 'Erro ao consultar a base vetorial'})
+        return
+    yield evento_sse("chunks", {"chunks": chunks, "mode": mode})
+
+    resposta, erro = preparar_rank(question, chunks, mode) if chunks else (None, 'São necessários 4 chunks')
+    if erro:
+        yield evento_sse("verdict", {'analise': None, 'chunk_selecionado': None, 'chunk_id': None,
+                                     'error': erro})
+        return
+    if resposta is None:
+        try:
+            resposta = montar_resposta_rank(ranquear(question, chunks), chunks)
+        except Exception:
+            yield evento_sse("error", {'error': 'Erro ao consultar a OpenAI'})
+            return
+    numero_chunk = resposta['chunk_selecionado']
+    yield evento_sse("verdict", {
+        'analise': resposta['analise'],
+        'chunk_selecionado': numero_chunk,
+        'chunk_id': chunks[numero_chunk - 1]['id'] if numero_chunk else None,
+        'llm': resposta.get('llm', True)
+    })
+
+@app.route('/ask', methods=['GET', 'POST'])
+def ask():
+    logger.info("Recebida requisição para /ask")
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        question = data.get('question', '') if isinstance(data, dict) else None
+    else:
+        question = request.args.get('question', '')
+    if not isinstance(question, str):
+        return jsonify({'error': 'question deve ser um texto'}), 400
+    question = question.strip()
+    if not question:
+        return jsonify({'error': 'Pergunta é obrigatória'}), 400
+    return Response(
+        stream_with_context(gerar_eventos_ask(question)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/rerank-stats', methods=['GET'])
+def rerank_stats():
+    estatisticas = cache_rerank.estatisticas()
+    estatisticas['coalesced'] = chamadas_rerank.coalescidas
+    estatisticas['avoided_tokens_estimate'] = _tokens_evitados
+    estatisticas['avoided_cost_usd_estimate'] = _tokens_evitados / 1000 * OPENAI_PRECO_1K_TOKENS
+    return jsonify(estatisticas)
@@ -0,0 +1,76 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class CoalescedorLotes:
+    """Junta itens que chegam juntos e processa todos numa chamada só.
+
+    Cada `enviar(item)` devolve um Future. Uma thread pega o primeiro item da
+    fila, espera até `janela_ms` (ou até `max_lote` itens) por outros e chama
+    `processar_lote(itens)`, que deve retornar um resultado por item, na mesma
+    ordem. Serve tanto para chamadas síncronas (`.result()`) quanto para
+    código asyncio (`asyncio.wrap_future`).
+    """
+
+    def __init__(self, processar_lote, janela_ms=5, max_lote=32):
+        self.processar_lote = processar_lote
+        self.janela = janela_ms / 1000
+        self.max_lote = max_lote
+        self.lotes = 0
+        self.itens = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fila = None
+
+    def enviar(self, item):
+        futuro = Future()
+        self._garantir_thread().put((item, futuro))
+        return futuro
+
+    def _garantir_thread(self):
+        # A thread é criada sob demanda e recriada depois de um fork (workers do gunicorn)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._fila = queue.Queue()
+                threading.Thread(target=self._executar, args=(self._fila,), daemon=True).start()
+            return self._fila
+
+    def _executar(self, fila):
+        while True:
+            lote = [fila.get()]
+            prazo = time.monotonic() + self.janela
+            while len(lote) < self.max_lote:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            # Descarta os itens cujo futuro já foi cancelado (ex: requisição asyncio
+            # cancelada, via asyncio.wrap_future); os demais não podem mais sê-lo
+            lote = [(item, futuro) for item, futuro in lote if futuro.set_running_or_notify_cancel()]
+            if not lote:
+                continue
+            self.lotes += 1
+            self.itens += len(lote)
+            try:
+                resultados = self.processar_lote([item for item, _ in lote])
+                for (_, futuro), resultado in zip(lote, resultados):
+                    futuro.set_result(resultado)
+            except Exception as e:
+                for _, futuro in lote:
+                    futuro.set_exception(e)
+
+    def estatisticas(self):
+        return {
+            "window_ms": self.janela * 1000,
+            "max_batch": self.max_lote,
+            "batches": self.lotes,
+            "items": self.itens,
+            "avg_batch_size": self.itens / self.lotes if self.lotes else 0.0
+        }
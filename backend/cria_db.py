@@ -4,33 +4,102 @@ import os
 from lxml import etree
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-import spacy
 import re
 import html
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams
+import time
+import uuid
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from qdrant_client.models import (
+    Batch, FieldCondition, Filter, MatchAny, Modifier, PayloadSchemaType, PointIdsList,
+    SparseVectorParams, VectorParams
+)
+from embeddings import EMBEDDING_MODEL, criar_embedder
+from qdrant_conexao import QDRANT_MODE, obter_cliente
+from lexico import SPARSE_VECTOR_NAME, vetor_esparso_documento
 
 # Caminho robusto, relativo ao local do script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 XML_PATH = os.path.join(BASE_DIR, "base", "JIRA.xml")
 
+UPLOAD_BATCH_SIZE = int(os.getenv("QDRANT_UPLOAD_BATCH_SIZE", 256))
+UPLOAD_PARALLEL = int(os.getenv("QDRANT_UPLOAD_PARALLEL", 4))
+# De quantos em quantos chunks o progresso é reportado (e tamanho do bloco de embedding)
+PROGRESSO_INTERVALO = 1000
+REINDEX_INCREMENTAL = os.getenv("REINDEX_INCREMENTAL", "1") == "1"
+# Ingestão com os estágios sobrepostos em processos (ver pipeline_ingestao.py)
+INGESTAO_PIPELINE = os.getenv("INGESTAO_PIPELINE", "1") == "1"
+# Abaixo disso (chunks novos estimados numa reindexação incremental) não compensa
+# subir os workers do pipeline
+PIPELINE_MIN_PENDENTES = int(os.getenv("PIPELINE_MIN_PENDENTES", 5000))
+# Bytes de XML por chunk, para a estimativa: chunk de 4000 caracteres, 500 de overlap
+BYTES_POR_CHUNK = 3500
+COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "jira")
+# Campos consultados por igualdade no /chat (ver planejar_buscas em api.py)
+CAMPOS_INDEXADOS = ["key", "text_raw", "text", "issue_key"]
+# Namespace fixo para que o mesmo (issue, offset) gere sempre o mesmo ID de ponto
+NAMESPACE_PONTOS = uuid.UUID("6f1c1b6e-5d0a-4e55-9a57-3b1f0f2d7c41")
+
+def extrair_issue_key(key, title, texto_puro):
+    """Chave estável do ticket: <key>, depois o [ABC-123] do título, senão hash do conteúdo."""
+    if key and key.strip():
+        return key.strip()
+    match = re.match(r"\[(\w+-\d+)\]", title.strip())
+    if match:
+        return match.group(1)
+    return hashlib.sha1(texto_puro.encode("utf-8")).hexdigest()
+
 def carregar_documentos_xml(xml_path):
+    """Lê o XML do JIRA em streaming, gerando um Document por <item>.
+
+    Usa iterparse para não carregar a árvore inteira em memória: cada item
+    é limpo (junto com os irmãos já processados) assim que é lido, então o
+    consumo de memória não cresce com o tamanho do export.
+
+    Um XML inválido ou truncado levanta o erro (depois dos itens já lidos):
+    quem consome precisa distinguir um export completo de um quebrado.
+    """
     try:
-        tree = etree.parse(xml_path)
-    except Exception as e:
+        contexto = etree.iterparse(xml_path, events=("end",), tag="item", huge_tree=True)
+        for _, item in contexto:
+            title = item.findtext('title') or ''
+            description = item.findtext('description') or ''
+            summary = item.findtext('summary') or ''
+            texto_puro = f"{title}\n{summary}\n{description}"
+            issue_key = extrair_issue_key(item.findtext('key'), title, texto_puro)
+            # Libera o item e os irmãos anteriores que ainda estão presos ao <channel>
+            item.clear(keep_tail=True)
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+            yield Document(page_content=texto_puro, metadata={"issue_key": issue_key})
+        del contexto
+    except (etree.XMLSyntaxError, OSError) as e:
         print(f"Erro ao ler XML: {e}")
-        return []
-    items = tree.xpath('//item')
-    documentos = []
-    textos_puros = []
-    for item in items:
-        title = item.findtext('title') or ''
-        description = item.findtext('description') or ''
-        summary = item.findtext('summary') or ''
-        texto_puro = f"{title}\n{summary}\n{description}"
-        documentos.append(Document(page_content=texto_puro))
-        textos_puros.append(texto_puro)
-    return documentos, textos_puros
+        raise
+
+def issue_para_documento(issue):
+    """Document de uma issue do JSON da API do JIRA, com o mesmo texto do <item> do XML exportado."""
+    campos = issue.get('fields') or {}
+    summary = campos.get('summary') or ''
+    description = campos.get('description') or ''
+    title = f"[{issue['key']}] {summary}"
+    texto_puro = f"{title}\n{summary}\n{description}"
+    return Document(page_content=texto_puro, metadata={"issue_key": issue['key']})
+
+def criar_separador():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=4000,
+        chunk_overlap=500,
+        length_function=len,
+        add_start_index=True
+    )
+
+def gerar_chunks(documentos, separador):
+    """Quebra os documentos em chunks um a um, sem materializar a lista de documentos."""
+    for documento in documentos:
+        for chunk in separador.split_documents([documento]):
+            yield chunk
 
 # Função de normalização
 def normalizar_texto(texto):
@@ -40,114 +109,368 @@ def normalizar_texto(texto):
     texto = re.sub(r'\s+', ' ', texto)
     return texto.strip().lower()
 
+def enviar_pontos(client, collection_name, ids, vectors, payloads, esparsos=None,
+                  batch_size=UPLOAD_BATCH_SIZE, parallel=UPLOAD_PARALLEL):
+    """Envia os pontos ao Qdrant em lotes, até `parallel` lotes ao mesmo tempo.
 
-def criar_db():
-    documentos, textos_puros = carregar_documentos_xml(XML_PATH)
-    if not documentos:
-        print("Nenhum documento carregado do XML. Abortando.")
-        return
+    Os lotes vão por upsert(wait=False) num pool de threads, como no estágio
+    de upsert do pipeline_ingestao. Não usa o upload_collection(parallel=...)
+    porque ele sobe um pool de processos, e isto roda dentro da API. Cada
+    linha da matriz só vira lista dentro do seu lote. O último lote vai com
+    wait=True depois que os outros foram aceitos: como o Qdrant aplica as
+    atualizações em ordem, quando ele retorna todos os anteriores já estão
+    aplicados.
+    """
+    total = len(ids)
+    if total == 0:
+        return 0
+    inicio = time.perf_counter()
 
+    def enviar_lote(de, ate, wait):
+        lote = vectors[de:ate].tolist()
+        if esparsos is not None:
+            lote = {"": lote, SPARSE_VECTOR_NAME: esparsos[de:ate]}
+        client.upsert(
+            collection_name=collection_name,
+            points=Batch(ids=ids[de:ate], vectors=lote, payloads=payloads[de:ate]),
+            wait=wait
+        )
 
-    # Chunking
-    separador = RecursiveCharacterTextSplitter(
-        chunk_size=4000,
-        chunk_overlap=500,
-        length_function=len,
-        add_start_index=True
-    )
-    chunks = separador.split_documents(documentos)
-    if not chunks:
-        print("Nenhum chunk gerado. Abortando.")
-        return
+    corte = max(total - batch_size, 0)
+    if corte:
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="upload") as pool:
+            futuros = [
+                pool.submit(enviar_lote, de, min(de + batch_size, corte), False)
+                for de in range(0, corte, batch_size)
+            ]
+            for futuro in futuros:
+                futuro.result()
+    enviar_lote(corte, total, True)
+    duracao = time.perf_counter() - inicio
+    print(f"Upload de {total} pontos em {duracao:.2f}s ({total / max(duracao, 1e-9):.0f} pontos/s)")
+    return total
 
-    print(f"Chunks gerados para indexação: {len(chunks)}")
-    for i, chunk in enumerate(chunks, 1):
-        print(f"\n--- Chunk {i} ---\n{chunk.page_content}\n")
+def tem_vetor_esparso(client, collection_name):
+    params = client.get_collection(collection_name=collection_name).config.params
+    return SPARSE_VECTOR_NAME in (params.sparse_vectors or {})
 
-    # Salvar texto puro correspondente a cada chunk
-    # Como estamos chunkando os documentos, associar texto puro ao chunk pode ser feito por índice
-    # (assume chunking 1:1 com documentos, se não, salva só o texto processado)
+def id_do_chunk(chunk):
+    """ID determinístico do ponto: chave do ticket + offset do chunk no documento."""
+    return str(uuid.uuid5(NAMESPACE_PONTOS, f"{chunk.metadata['issue_key']}:{chunk.metadata['start_index']}"))
 
-    # Carregar modelo spaCy offline
-    try:
-        nlp = spacy.load("pt_core_news_md")
-    except Exception as e:
-        print("Erro ao carregar modelo spaCy. Rode: python -m spacy download pt_core_news_md")
-        print(e)
-        return
+def chunks_do_xml(xml_path, separador):
+    """Gera (chunk, overlap, id, hash) de cada chunk do XML, um documento por vez."""
+    for documento in carregar_documentos_xml(xml_path):
+        chunks = separador.split_documents([documento])
+        for chunk, overlap in zip(chunks, calcular_overlaps(chunks)):
+            yield chunk, overlap, id_do_chunk(chunk), hash_do_chunk(chunk, overlap)
 
-    # Gerar embeddings spaCy para cada chunk (usando texto normalizado)
-    vectors = []
-    for idx, chunk in enumerate(chunks):
-        texto_norm = normalizar_texto(chunk.page_content)
-        if not texto_norm.strip():
-            print(f"[AVISO] Chunk {idx} está vazio após normalização!")
-        vec = nlp(texto_norm).vector
-        if vec is None or len(vec) == 0:
-            print(f"[ERRO] Vetor não gerado para chunk {idx}!")
-        vectors.append(vec)
-    # Checagem de dimensão
-    dim = vectors[0].shape[0]
-    for idx, vec in enumerate(vectors):
-        if vec is None or len(vec) != dim:
-            print(f"[ERRO] Chunk {idx} tem vetor inválido ou dimensão errada: {vec}")
-    if not vectors or any(vec is None or len(vec) != dim for vec in vectors):
-        print("Erro ao gerar embeddings spaCy: vetor inválido ou dimensão inconsistente.")
-        return
+def calcular_overlaps(chunks):
+    """Tamanho do trecho inicial de cada chunk repetido do chunk anterior.
+
+    Calculado em O(1) por chunk a partir do start_index do splitter; só há
+    overlap entre chunks consecutivos do mesmo ticket.
+    """
+    overlaps = []
+    anterior = None
+    for chunk in chunks:
+        overlap = 0
+        inicio = chunk.metadata.get("start_index", -1)
+        if anterior is not None and inicio >= 0 and anterior.metadata["issue_key"] == chunk.metadata["issue_key"]:
+            fim_anterior = anterior.metadata.get("start_index", -1) + len(anterior.page_content)
+            overlap = min(max(fim_anterior - inicio, 0), len(chunk.page_content))
+        overlaps.append(overlap)
+        anterior = chunk
+    return overlaps
+
+def hash_do_chunk(chunk, overlap):
+    # O modelo entra no hash para que trocar de modelo force a reindexação
+    conteudo = f"{EMBEDDING_MODEL}\n{overlap}\n{chunk.page_content}"
+    return hashlib.sha1(conteudo.encode("utf-8")).hexdigest()
+
+def filtro_issues(issue_keys):
+    return Filter(must=[FieldCondition(key="issue_key", match=MatchAny(any=list(issue_keys)))])
+
+def carregar_hashes(client, collection_name, batch_size=1000, filtro=None, origens=None):
+    """Lê {id: hash} dos pontos da collection (todos, ou só os do filtro), sem trazer vetores.
+
+    Se `origens` (um dict) for passado, ele recebe {id: origem} dos pontos
+    criados pela sincronização/importação do JIRA (ver sincroniza_jira.py).
+    """
+    hashes = {}
+    offset = None
+    while True:
+        pontos, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=filtro,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["hash", "origem"],
+            with_vectors=False
+        )
+        for ponto in pontos:
+            payload = ponto.payload or {}
+            hashes[ponto.id] = payload.get("hash")
+            if origens is not None and payload.get("origem"):
+                origens[ponto.id] = payload["origem"]
+        if offset is None:
+            return hashes
+
+def obsoletos_do_xml(hashes_existentes, ids_xml, origens):
+    """Pontos que sumiram do XML, sem contar os da sincronização com o JIRA.
+
+    Esses têm origem e são removidos só pela reconciliação da JQL que os
+    criou: um XML que não traz a issue não significa que ela saiu do JIRA.
+    """
+    return [id_ for id_ in hashes_existentes if id_ not in ids_xml and id_ not in origens]
 
-    # Salvar no Qdrant manualmente
-    client = QdrantClient(host="localhost", port=6333)
-    collection_name = "jira"
-    dim = vectors[0].shape[0]
+def _sem_progresso(etapa, feitos, total=None):
+    pass
 
-    # Cria a collection apenas se não existir
+def vai_recriar(client, collection_name, incremental=True):
+    """Se o preparar_collection vai apagar uma collection existente."""
     if not client.collection_exists(collection_name=collection_name):
+        return False
+    return not incremental or not tem_vetor_esparso(client, collection_name)
+
+def preparar_collection(client, collection_name, dim, incremental=True, recriar_sem_esparso=True):
+    """Garante a collection (denso + BM25) e os índices de payload.
+
+    Recria do zero se não for incremental ou se a collection existente não
+    tiver o vetor esparso. Retorna se o modo incremental foi mantido.
+
+    Com `recriar_sem_esparso=False` (sincronização/importação do JIRA, que só
+    reenviam as issues da JQL) uma collection sem o vetor esparso não é
+    apagada: levanta RuntimeError pedindo uma reindexação completa do XML.
+    """
+    existe = client.collection_exists(collection_name=collection_name)
+    if existe and incremental and not tem_vetor_esparso(client, collection_name):
+        if not recriar_sem_esparso:
+            raise RuntimeError(
+                f"A collection '{collection_name}' não tem o vetor esparso (BM25) e precisaria ser recriada, "
+                "o que apagaria os pontos fora desta JQL. Reindexe o JIRA.xml (upload ou cria_db.py) antes."
+            )
+        print("Collection sem vetor esparso (BM25); recriando do zero.")
+        incremental = False
+    if existe and not incremental:
+        client.delete_collection(collection_name=collection_name)
+        existe = False
+    if not existe:
         client.create_collection(
             collection_name=collection_name,
-            vectors_config=VectorParams(size=dim, distance="Cosine")
+            vectors_config=VectorParams(size=dim, distance="Cosine"),
+            sparse_vectors_config={SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)}
+        )
+    # Índices keyword para os campos usados nas buscas exatas do /chat (e para a
+    # origem, usada na reconciliação da sincronização com o JIRA)
+    for campo in CAMPOS_INDEXADOS + ["origem"]:
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=campo,
+            field_schema=PayloadSchemaType.KEYWORD
         )
+    return incremental
+
+def montar_payload(chunk, texto_norm, overlap, hash_chunk, origem=None):
+    texto_puro = chunk.page_content
+    # Extrair chave do card (ex: GMUD-16765) do início do texto
+    key = None
+    match = re.match(r"\[(\w+-\d+)\]", texto_puro.strip())
+    if match:
+        key = match.group(1)
+    # Overlap guardado como offset: text_raw[:overlap_end] repete o fim do chunk anterior
+    payload = {
+        "text": texto_norm,
+        "text_raw": texto_puro,
+        "overlap_end": overlap,
+        "key": key if key else "",
+        "issue_key": chunk.metadata["issue_key"],
+        "start_index": chunk.metadata["start_index"],
+        "hash": hash_chunk
+    }
+    if origem:
+        payload["origem"] = origem
+    return payload
+
+def indexar_chunks(client, collection_name, embedder, chunks, pendentes, ids, overlaps, hashes,
+                   progresso=_sem_progresso, origem=None, origens=None):
+    """Embeda e envia ao Qdrant os chunks de índice em `pendentes`. Retorna quantos foram enviados.
+
+    `origem` marca os pontos (payload "origem") para que quem os criou possa
+    reconciliá-los depois, ver sincroniza_jira.py. `origens` ({id: origem})
+    preserva a origem de pontos que já a tinham ao serem reenviados.
+    """
+    if not pendentes:
+        return 0
+    # Gerar embeddings spaCy para cada chunk pendente (usando texto normalizado)
+    textos_norm = []
+    for i in pendentes:
+        texto_norm = normalizar_texto(chunks[i].page_content)
+        if not texto_norm:
+            print(f"[AVISO] Chunk {i} está vazio após normalização!")
+        textos_norm.append(texto_norm)
+    vectors = np.empty((len(textos_norm), embedder.dim), dtype=np.float32)
+    progresso("embed", 0, len(textos_norm))
+    for inicio in range(0, len(textos_norm), PROGRESSO_INTERVALO):
+        fim = inicio + PROGRESSO_INTERVALO
+        vectors[inicio:fim] = embedder.embed_lote(textos_norm[inicio:fim])
+        progresso("embed", min(fim, len(textos_norm)), len(textos_norm))
+    if vectors.shape[0] != len(pendentes) or vectors.shape[1] == 0:
+        raise ValueError("Erro ao gerar embeddings spaCy: vetor inválido ou dimensão inconsistente.")
 
     # Indexar os chunks
-    payloads = []
-    for i, chunk in enumerate(chunks):
-        texto_puro = chunk.page_content
-        texto_normalizado = normalizar_texto(texto_puro)
-        # Extrair chave do card (ex: GMUD-16765) do início do texto
-        key = None
-        match = re.match(r"\[(\w+-\d+)\]", texto_puro.strip())
-        if match:
-            key = match.group(1)
-        # Calcular overlap: trecho em comum com chunk anterior
-        overlap = None
-        if i > 0:
-            prev = chunks[i-1].page_content
-            overlap_size = 500  # mesmo valor do chunk_overlap
-            overlap = prev[-overlap_size:] if len(prev) >= overlap_size else prev
-            if not texto_puro.startswith(overlap):
-                for j in range(overlap_size, 0, -1):
-                    if texto_puro.startswith(prev[-j:]):
-                        overlap = prev[-j:]
-                        break
-        payloads.append({
-            "text": texto_normalizado,
-            "text_raw": texto_puro,
-            "overlap": overlap if overlap else "",
-            "key": key if key else ""
-        })
-    try:
-        client.upsert(
+    payloads = [
+        montar_payload(chunks[i], textos_norm[pos], overlaps[i], hashes[i], (origens or {}).get(ids[i], origem))
+        for pos, i in enumerate(pendentes)
+    ]
+    esparsos = [vetor_esparso_documento(texto_norm) for texto_norm in textos_norm]
+    progresso("upsert", 0, len(pendentes))
+    enviar_pontos(client, collection_name, [ids[i] for i in pendentes], vectors, payloads, esparsos)
+    progresso("upsert", len(pendentes), len(pendentes))
+    return len(pendentes)
+
+def indexar_pendentes_xml(client, collection_name, embedder, xml_path, separador, hashes_xml, pendentes,
+                          progresso=_sem_progresso, origens=None):
+    """Relê o XML e indexa só os chunks em `pendentes`, em blocos de PROGRESSO_INTERVALO.
+
+    Só um bloco fica em memória por vez. Se um ID aparece mais de uma vez no
+    XML vale a versão cujo hash está em `hashes_xml` (a última lida).
+    """
+    restantes = set(pendentes)
+    total = len(restantes)
+    enviados = 0
+    bloco = []
+
+    def enviar_bloco():
+        indices = range(len(bloco))
+        chunks, overlaps, ids, hashes = (list(coluna) for coluna in zip(*bloco))
+        n = indexar_chunks(client, collection_name, embedder, chunks, indices, ids, overlaps, hashes, origens=origens)
+        bloco.clear()
+        progresso("embed", enviados + n, total)
+        progresso("upsert", enviados + n, total)
+        return n
+
+    progresso("embed", 0, total)
+    for chunk, overlap, id_, hash_chunk in chunks_do_xml(xml_path, separador):
+        if id_ not in restantes or hashes_xml[id_] != hash_chunk:
+            continue
+        restantes.discard(id_)
+        bloco.append((chunk, overlap, id_, hash_chunk))
+        if len(bloco) >= PROGRESSO_INTERVALO:
+            enviados += enviar_bloco()
+    if bloco:
+        enviados += enviar_bloco()
+    return enviados
+
+def remover_pontos(client, collection_name, ids):
+    if ids:
+        client.delete(
             collection_name=collection_name,
-            points=[
-                {
-                    "id": i,
-                    "vector": vec.tolist(),
-                    "payload": payload
-                }
-                for i, (vec, payload) in enumerate(zip(vectors, payloads))
-            ]
+            points_selector=PointIdsList(points=list(ids)),
+            wait=True
         )
-        print(f"Banco de Dados criado no Qdrant com embeddings spaCy 100% offline! Total de chunks: {len(chunks)}")
+
+def usar_pipeline(client, xml_path, incremental):
+    """Decide, sem ler o XML, se a ingestão vale o pipeline (a seleção por hash fica com ele).
+
+    Estima os chunks do XML pelo tamanho do arquivo. Quando tudo vai ser
+    embedado (modo completo, collection nova ou recriada) basta que sejam ao
+    menos PIPELINE_MIN_PENDENTES; no incremental, desconta os pontos que a
+    collection já tem: só uma base bem maior que a indexada compensa subir
+    os workers.
+    """
+    try:
+        estimados = os.path.getsize(xml_path) // BYTES_POR_CHUNK
+    except OSError:
+        return False  # o caminho sequencial reporta o erro de leitura
+    if not client.collection_exists(collection_name=COLLECTION_NAME) or vai_recriar(client, COLLECTION_NAME, incremental):
+        return estimados >= PIPELINE_MIN_PENDENTES
+    pontos = client.count(collection_name=COLLECTION_NAME, exact=False).count
+    return estimados - pontos >= PIPELINE_MIN_PENDENTES
+
+def criar_db(xml_path=XML_PATH, incremental=REINDEX_INCREMENTAL, progresso=_sem_progresso, pipeline=INGESTAO_PIPELINE):
+    """Indexa o JIRA.xml no Qdrant.
+
+    No modo incremental só os chunks novos ou alterados (pelo hash) são
+    embedados e enviados, e os pontos que sumiram do export são removidos.
+    No modo completo a collection é recriada do zero.
+
+    `progresso(etapa, feitos, total)` é chamado a cada avanço das etapas
+    parse/chunk/embed/upsert. Retorna um dict com as estatísticas da
+    indexação, ou None se ela foi abortada.
+
+    Com `pipeline` as etapas rodam sobrepostas, em vários processos, quando
+    a ingestão é grande (ver usar_pipeline). Com o Qdrant embarcado
+    (QDRANT_MODE=local) o storage só abre num processo, então é sempre aqui.
+    """
+    if pipeline and QDRANT_MODE == "server" and usar_pipeline(obter_cliente(), xml_path, incremental):
+        from pipeline_ingestao import criar_db_pipeline
+        return criar_db_pipeline(xml_path, incremental, progresso)
+
+    # 1ª leitura: só {id: hash} de cada chunk, sem guardar os textos. Também
+    # valida o XML inteiro antes de mexer na collection
+    separador = criar_separador()
+    progresso("parse", 0)
+    hashes_xml = {}
+    total_chunks = 0
+    try:
+        for _, _, id_, hash_chunk in chunks_do_xml(xml_path, separador):
+            hashes_xml[id_] = hash_chunk
+            total_chunks += 1
+            if total_chunks % PROGRESSO_INTERVALO == 0:
+                progresso("chunk", total_chunks)
+    except (etree.XMLSyntaxError, OSError):
+        # Export parcial: tratar como completo removeria todos os pontos depois da quebra
+        print("XML inválido ou truncado; a base não foi alterada. Abortando.")
+        return
+    progresso("chunk", total_chunks, total_chunks)
+    if not total_chunks:
+        print("Nenhum chunk gerado a partir do XML. Abortando.")
+        return
+    print(f"Chunks gerados para indexação: {total_chunks}")
+
+    # Carregar modelo spaCy offline
+    try:
+        embedder = criar_embedder()
+    except Exception as e:
+        print(f"Erro ao carregar modelo spaCy. Rode: python -m spacy download {EMBEDDING_MODEL}")
+        print(e)
+        return
+
+    client = obter_cliente()
+    collection_name = COLLECTION_NAME
+    incremental = preparar_collection(client, collection_name, embedder.dim, incremental)
+    origens = {}
+    hashes_existentes = carregar_hashes(client, collection_name, origens=origens) if incremental else {}
+
+    # Seleciona só os chunks novos ou alterados
+    pendentes = {id_ for id_, hash_chunk in hashes_xml.items() if hashes_existentes.get(id_) != hash_chunk}
+    obsoletos = obsoletos_do_xml(hashes_existentes, hashes_xml, origens)
+    print(f"Chunks novos/alterados: {len(pendentes)} | inalterados: {total_chunks - len(pendentes)} | removidos: {len(obsoletos)}")
+
+    # 2ª leitura: embeda e envia os pendentes em blocos
+    try:
+        indexar_pendentes_xml(client, collection_name, embedder, xml_path, separador, hashes_xml, pendentes,
+                              progresso, origens)
     except Exception as e:
         print(f"Erro ao salvar no Qdrant: {e}")
+        return
+
+    remover_pontos(client, collection_name, obsoletos)
+    print(f"Banco de Dados atualizado no Qdrant com embeddings spaCy 100% offline! Total de chunks: {total_chunks}")
+    return {
+        "chunks": total_chunks,
+        "atualizados": len(pendentes),
+        "removidos": len(obsoletos)
+    }
 
-criar_db()
\ No newline at end of file
+if __name__ == "__main__":
+    from cache import GeracaoCompartilhada
+    from travas import trava_ingestao
+    # Mesma trava e geração da API: não roda junto com uma ingestão dela, e
+    # os workers param de servir resultados antigos do cache
+    with trava_ingestao(COLLECTION_NAME):
+        try:
+            criar_db()
+        finally:
+            GeracaoCompartilhada(f"geracao-{COLLECTION_NAME}").incrementar()
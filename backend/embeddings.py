@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import spacy
+from spacy.attrs import ORTH
+
+# Configurações
+EMBEDDING_MODEL = os.getenv("SPACY_MODEL", "pt_core_news_md")
+# "vectors": só tokeniza e faz a média da tabela de vetores (rápido)
+# "pipeline": roda o pipeline spaCy (nlp.pipe) e usa doc.vector
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "vectors")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_N_PROCESS = int(os.getenv("EMBED_N_PROCESS", 1))
+# Tabela de vetores salva em .npy e aberta com mmap (só leitura): processos que
+# carregam o mesmo modelo compartilham as páginas pelo page cache do SO
+EMBED_VECTORS_MMAP = os.getenv("EMBED_VECTORS_MMAP", "1") == "1"
+VECTORS_MMAP_DIR = os.getenv("VECTORS_MMAP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_vetores"))
+
+# Componentes do pipeline que o doc.vector não usa (ele só depende do tokenizer + tabela de vetores)
+COMPONENTES_DESNECESSARIOS = [
+    "tok2vec", "morphologizer", "tagger", "parser", "senter",
+    "attribute_ruler", "lemmatizer", "ner",
+]
+
+
+def carregar_modelo(modelo=EMBEDDING_MODEL, mmap=EMBED_VECTORS_MMAP):
+    """Carrega o modelo spaCy apenas com o tokenizer e a tabela de vetores."""
+    nlp = spacy.load(modelo, exclude=COMPONENTES_DESNECESSARIOS)
+    if mmap and nlp.vocab.vectors.mode == "default" and nlp.vocab.vectors_length:
+        nlp.vocab.vectors.data = mapear_vetores(nlp, modelo)
+    return nlp
+
+
+def mapear_vetores(nlp, modelo):
+    """Troca a tabela de vetores em memória por um memmap somente leitura do mesmo conteúdo."""
+    dados = np.asarray(nlp.vocab.vectors.data, dtype=np.float32)
+    versao = nlp.meta.get("version", "0")
+    nome = os.path.basename(os.path.normpath(modelo))
+    caminho = os.path.join(VECTORS_MMAP_DIR, f"{nome}-{versao}-{dados.shape[0]}x{dados.shape[1]}.npy")
+    if not os.path.exists(caminho):
+        os.makedirs(VECTORS_MMAP_DIR, exist_ok=True)
+        temporario = f"{caminho}.{os.getpid()}.tmp"
+        with open(temporario, "wb") as f:
+            np.save(f, dados)
+        os.replace(temporario, caminho)
+    return np.load(caminho, mmap_mode="r")
+
+
+class EmbedderPipeline:
+    """Embeddings via nlp.pipe + doc.vector, com lotes e multiprocessamento."""
+
+    def __init__(self, nlp, batch_size=EMBED_BATCH_SIZE, n_process=EMBED_N_PROCESS):
+        self.nlp = nlp
+        self.dim = nlp.vocab.vectors_length
+        self.batch_size = batch_size
+        self.n_process = n_process
+
+    def embed(self, texto):
+        return self.nlp(texto).vector.astype(np.float32, copy=False)
+
+    def embed_lote(self, textos):
+        """Retorna uma matriz float32 contígua (n_textos x dim), uma linha por texto."""
+        matriz = np.zeros((len(textos), self.dim), dtype=np.float32)
+        docs = self.nlp.pipe(textos, batch_size=self.batch_size, n_process=self.n_process)
+        for idx, doc in enumerate(docs):
+            if doc.has_vector:
+                matriz[idx] = doc.vector
+        return matriz
+
+
+class EmbedderVetores:
+    """Embeddings direto da tabela nlp.vocab.vectors, sem rodar o pipeline.
+
+    Reproduz o doc.vector do spaCy: média dos vetores de todos os tokens,
+    contando tokens fora do vocabulário como zero. As linhas são buscadas
+    pelo mesmo atributo do token que a tabela usa (vectors.attr, ORTH por
+    padrão), como o spaCy faz.
+    """
+
+    def __init__(self, nlp, batch_size=EMBED_BATCH_SIZE):
+        if nlp.vocab.vectors.mode != "default":
+            raise ValueError(f"Tabela de vetores em modo '{nlp.vocab.vectors.mode}' não suportada")
+        self.nlp = nlp
+        self.tokenizer = nlp.tokenizer
+        self.vectors = nlp.vocab.vectors
+        self.attr = getattr(self.vectors, "attr", ORTH)
+        self.tabela = np.asarray(self.vectors.data, dtype=np.float32)
+        self.dim = self.tabela.shape[1]
+        self.batch_size = batch_size
+
+    def _media(self, doc, saida):
+        if not len(doc):
+            return saida
+        linhas = self.vectors.find(keys=doc.to_array(self.attr).tolist())
+        linhas = linhas[linhas >= 0]
+        if linhas.size:
+            np.sum(self.tabela[linhas], axis=0, out=saida)
+            saida /= len(doc)
+        return saida
+
+    def embed(self, texto):
+        return self._media(self.tokenizer(texto), np.zeros(self.dim, dtype=np.float32))
+
+    def embed_lote(self, textos):
+        """Retorna uma matriz float32 contígua (n_textos x dim), uma linha por texto."""
+        matriz = np.zeros((len(textos), self.dim), dtype=np.float32)
+        for idx, doc in enumerate(self.tokenizer.pipe(textos, batch_size=self.batch_size)):
+            self._media(doc, matriz[idx])
+        return matriz
+
+
+def criar_embedder(nlp=None, backend=EMBEDDING_BACKEND):
+    """Cria o embedder configurado em EMBEDDING_BACKEND."""
+    if nlp is None:
+        nlp = carregar_modelo()
+    if backend == "pipeline":
+        return EmbedderPipeline(nlp)
+    if backend == "vectors":
+        return EmbedderVetores(nlp)
+    raise ValueError(f"EMBEDDING_BACKEND inválido: {backend}")
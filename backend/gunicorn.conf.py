@@ -0,0 +1,54 @@
+"""
+Configuração do gunicorn para servir a API com vários workers.
+
+O app é carregado no master antes do fork (preload_app), então o modelo
+spaCy e a tabela de vetores (um memmap somente leitura, ver embeddings.py)
+ficam em páginas compartilhadas por todos os workers via copy-on-write, em
+vez de uma cópia por worker. Os clientes do Qdrant são recriados em cada
+worker, porque conexões (HTTP/gRPC) não podem ser herdadas pelo fork.
+
+Para rodar (de dentro de backend/):
+    gunicorn -c gunicorn.conf.py api:app
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker api_async:asgi_app
+
+O modo multi-worker exige QDRANT_MODE=server: a base embutida (local/memory)
+pertence a um único processo. Os workers compartilham, por arquivos em
+ESTADO_DIR (ver travas.py), a trava de ingestão (uma reindexação por
+collection em toda a máquina), a geração da collection (que entra na chave
+do cache, então nenhum worker serve resultados anteriores à reindexação) e
+o estado dos jobs (qualquer worker responde o /jobs/<id>, ver jobs.py).
+
+Para ver a memória de cada worker:
+    python memoria.py --pidfile gunicorn.pid
+(ou GET /memory, que responde com os números do worker que atendeu)
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+preload_app = True
+pidfile = os.getenv("GUNICORN_PIDFILE", "gunicorn.pid")
+
+if os.getenv("QDRANT_MODE", "server") != "server" and workers > 1:
+    raise RuntimeError("Modo multi-worker exige QDRANT_MODE=server (a base embutida não é compartilhável entre processos)")
+
+
+def pre_fork(server, worker):
+    # Tira os objetos já carregados (modelo, vocabulário) da coleta do GC, que
+    # senão tocaria neles em cada worker e forçaria a cópia das páginas
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import qdrant_conexao
+    import api
+    api.client = qdrant_conexao.reiniciar_cliente()
+    api_async = sys.modules.get("api_async")
+    if api_async is not None:
+        api_async._cliente_async = None
+    server.log.info(f"Worker {worker.pid} pronto (modelo compartilhado com o master)")
@@ -4,11 +4,16 @@ Script para integração com JIRA para extrair issues no formato XML usando JQL
 """
 from flask import Flask, request, jsonify
 import requests
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from lxml import etree as ET
+import re
 import argparse
 import os
 import sys
+import io
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 app = Flask(__name__)
@@ -19,6 +24,49 @@ JIRA_CONFIG = {
     'email': os.getenv('JIRA_EMAIL', 'your-email@example.com'),
     'api_token': os.getenv('JIRA_API_TOKEN', 'your-api-token')
 }
+# Caracteres que não podem aparecer em XML 1.0 (o lxml recusa)
+CARACTERES_INVALIDOS_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xml_seguro(texto):
+    if not texto:
+        return texto
+    return CARACTERES_INVALIDOS_XML.sub('', texto)
+
+# Paginação da busca
+PAGE_SIZE = int(os.getenv('JIRA_PAGE_SIZE', 100))
+WORKERS = int(os.getenv('JIRA_WORKERS', 4))
+MAX_TENTATIVAS = 5
+BACKOFF_BASE = 1.0
+# (conexão, leitura) em segundos: sem isso um socket parado prende o job de ingestão para sempre
+JIRA_TIMEOUT = (float(os.getenv('JIRA_CONNECT_TIMEOUT', 10)), float(os.getenv('JIRA_READ_TIMEOUT', 60)))
+
+# Perfis de campos pedidos ao /search. Só vem o que o perfil usa, em vez de
+# '*all' + todas as expansões (respostas muitas vezes maiores):
+#   minimal: o que o cria_db indexa (title/summary/description; a key sempre vem)
+#   rag:     o que o _issue_to_xml escreve
+#   full:    tudo, como antes
+PERFIS_CAMPOS = {
+    'minimal': {
+        'fields': 'summary,description'
+    },
+    'rag': {
+        'fields': 'summary,description,environment,project,issuetype,priority,status,resolution,'
+                  'assignee,reporter,labels,created,updated,duedate,votes,watches,comment'
+    },
+    'full': {
+        'fields': '*all',
+        'expand': 'renderedFields,names,schema,operations,editmeta,changelog,versionedRepresentations'
+    },
+}
+FIELD_PROFILE = os.getenv('JIRA_FIELD_PROFILE', 'rag')
+
+class ErroConsultaJira(RuntimeError):
+    """Resposta de erro do JIRA; `status` é o código HTTP (400 = JQL inválida), ou None se ele não respondeu."""
+
+    def __init__(self, status, mensagem):
+        super().__init__(mensagem)
+        self.status = status
+
 class JiraXMLExporter:
     def __init__(self, url, email, api_token):
         """
@@ -35,13 +83,40 @@ class JiraXMLExporter:
         self.session.auth = self.auth
         self.session.headers.update({
             'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
             'Content-Type': 'application/json'
         })
+        self._lock_medicao = threading.Lock()
+        self.zerar_medicao()
+
+    def zerar_medicao(self):
+        with self._lock_medicao:
+            self.medicao = {'paginas': 0, 'bytes_rede': 0, 'bytes_json': 0, 'segundos': 0.0}
+
+    def _registrar_pagina(self, response, segundos):
+        # tell() conta os bytes lidos do socket (comprimidos); content já vem descomprimido
+        with self._lock_medicao:
+            self.medicao['paginas'] += 1
+            self.medicao['bytes_rede'] += response.raw.tell() or len(response.content)
+            self.medicao['bytes_json'] += len(response.content)
+            self.medicao['segundos'] += segundos
+
+    def estatisticas_paginas(self):
+        """Médias por página das buscas feitas desde o último zerar_medicao()"""
+        with self._lock_medicao:
+            m = dict(self.medicao)
+        paginas = m['paginas'] or 1
+        return {
+            'paginas': m['paginas'],
+            'kb_rede_por_pagina': m['bytes_rede'] / paginas / 1024,
+            'kb_json_por_pagina': m['bytes_json'] / paginas / 1024,
+            'ms_por_pagina': m['segundos'] / paginas * 1000
+        }
     
     def test_connection(self):
         """Testa a conexão com o JIRA"""
         try:
-            response = self.session.get(f"{self.base_url}/rest/api/2/myself")
+            response = self.session.get(f"{self.base_url}/rest/api/2/myself", timeout=JIRA_TIMEOUT)
             if response.status_code == 200:
                 print(f"Conexão bem-sucedida! Usuário: {response.json()['displayName']}")
                 return True
@@ -52,82 +127,184 @@ class JiraXMLExporter:
             print(f"Erro ao conectar com JIRA: {str(e)}")
             return False
     
-    def jql_to_xml(self, jql_query, max_results=100, output_file=None):
+    def _buscar_pagina(self, params, start_at, page_size):
+        """
+        Busca uma página do /rest/api/2/search, respeitando 429/Retry-After
+
+        Falhas de rede (conexão, timeout) também são repetidas com backoff.
+
+        Returns:
+            dict: JSON da página
+        """
+        pagina_params = dict(params, startAt=start_at, maxResults=page_size)
+        for tentativa in range(MAX_TENTATIVAS):
+            inicio = time.perf_counter()
+            try:
+                response = self.session.get(f"{self.base_url}/rest/api/2/search", params=pagina_params,
+                                            timeout=JIRA_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if tentativa == MAX_TENTATIVAS - 1:
+                    raise ErroConsultaJira(None, f"JIRA não respondeu (startAt={start_at}): {e}") from e
+                espera = BACKOFF_BASE * (2 ** tentativa)
+                print(f"Falha de rede no JIRA ({type(e).__name__}, startAt={start_at}); nova tentativa em {espera:.1f}s")
+                time.sleep(espera)
+                continue
+            if response.status_code == 200:
+                dados = response.json()
+                self._registrar_pagina(response, time.perf_counter() - inicio)
+                return dados
+            if response.status_code in (429, 502, 503, 504) and tentativa < MAX_TENTATIVAS - 1:
+                retry_after = response.headers.get('Retry-After')
+                espera = float(retry_after) if retry_after and retry_after.isdigit() else BACKOFF_BASE * (2 ** tentativa)
+                print(f"JIRA respondeu {response.status_code} (startAt={start_at}); nova tentativa em {espera:.1f}s")
+                time.sleep(espera)
+                continue
+            raise ErroConsultaJira(response.status_code, f"Erro na consulta JQL: {response.status_code} - {response.text}")
+
+    def iterar_paginas(self, params, max_results=None, page_size=PAGE_SIZE, workers=WORKERS):
+        """
+        Gera as páginas de issues de uma consulta JQL, na ordem
+
+        A primeira página informa o total; as demais são buscadas em paralelo
+        (até `workers` ao mesmo tempo) e entregues em ordem de startAt.
+
+        Args:
+            params (dict): Parâmetros da busca (jql, fields, expand)
+            max_results (int): Número máximo de issues (None ou 0 = todas)
+            page_size (int): Issues por página
+            workers (int): Páginas buscadas em paralelo
+
+        Yields:
+            tuple: (total, lista de issues da página)
+        """
+        primeira = self._buscar_pagina(params, 0, min(page_size, max_results or page_size))
+        total = primeira.get('total', 0)
+        limite = min(total, max_results) if max_results else total
+        issues = primeira.get('issues', [])[:limite]
+        yield total, issues
+        if not issues:
+            return
+        # O JIRA pode limitar o maxResults; usa o tamanho que ele realmente aplicou
+        page_size = primeira.get('maxResults') or page_size
+        inicios = range(len(issues), limite, page_size)
+        # No máximo `workers` páginas adiantadas: se quem consome for mais lento
+        # (ex.: embedding), as páginas não se acumulam em memória
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pendentes = deque()
+            for start_at in inicios:
+                if len(pendentes) >= workers:
+                    yield total, pendentes.popleft().result().get('issues', [])
+                pendentes.append(executor.submit(
+                    self._buscar_pagina, params, start_at, min(page_size, limite - start_at)
+                ))
+            while pendentes:
+                yield total, pendentes.popleft().result().get('issues', [])
+
+    def parametros_busca(self, jql_query, perfil=FIELD_PROFILE):
+        """Parâmetros do /search (jql, fields, expand) para o perfil de campos"""
+        if perfil not in PERFIS_CAMPOS:
+            raise ValueError(f"Perfil de campos inválido: {perfil} (use {', '.join(PERFIS_CAMPOS)})")
+        return dict(PERFIS_CAMPOS[perfil], jql=jql_query)
+
+    def comparar_perfis(self, jql_query, page_size=PAGE_SIZE, repeticoes=3):
+        """
+        Mede tamanho e latência de uma página da consulta em cada perfil de campos
+
+        Returns:
+            dict: perfil -> estatisticas_paginas()
+        """
+        resultados = {}
+        for perfil in PERFIS_CAMPOS:
+            params = self.parametros_busca(jql_query, perfil)
+            self.zerar_medicao()
+            for _ in range(repeticoes):
+                self._buscar_pagina(params, 0, page_size)
+            resultados[perfil] = self.estatisticas_paginas()
+        self.zerar_medicao()
+        return resultados
+
+    def jql_to_xml(self, jql_query, max_results=100, output_file=None, page_size=PAGE_SIZE, workers=WORKERS,
+                   perfil=FIELD_PROFILE):
         """
         Executa uma consulta JQL e retorna os resultados em formato XML
         
         Args:
             jql_query (str): Consulta JQL
-            max_results (int): Número máximo de resultados
+            max_results (int): Número máximo de resultados (None ou 0 = todos)
             output_file (str): Caminho do arquivo para salvar o XML
+            page_size (int): Issues por página na API do JIRA
+            workers (int): Páginas buscadas em paralelo
+            perfil (str): Perfil de campos (minimal, rag ou full)
+            
+        Com output_file, os <item>s são gravados à medida que as páginas chegam
+        (memória constante) e o retorno é o caminho do arquivo.
             
         Returns:
-            str: XML com os resultados ou None em caso de erro
+            str: XML com os resultados (ou o caminho do arquivo) ou None em caso de erro
         """
         print(f"Executando consulta JQL: {jql_query}")
         
-        # Parâmetros da consulta
-        params = {
-            'jql': jql_query,
-            'maxResults': max_results,
-            'fields': '*all',  # Todos os campos
-            'expand': 'renderedFields,names,schema,operations,editmeta,changelog,versionedRepresentations'
-        }
-        
         try:
-            # Executar a consulta JQL
-            response = self.session.get(
-                f"{self.base_url}/rest/api/2/search",
-                params=params
-            )
-            
-            if response.status_code != 200:
-                print(f"Erro na consulta JQL: {response.status_code} - {response.text}")
-                return None
-            
-            data = response.json()
-            issues = data.get('issues', [])
-            total = data.get('total', 0)
-            
-            print(f"Encontradas {total} issues. Convertendo {len(issues)} para XML...")
-            
-            # Criar o XML base
-            rss = ET.Element('rss')
-            rss.set('version', '2.0')
-            channel = ET.SubElement(rss, 'channel')
-            
-            ET.SubElement(channel, 'title').text = 'JIRA Export'
-            ET.SubElement(channel, 'description').text = f'JIRA Issues Export - Query: {jql_query}'
-            ET.SubElement(channel, 'link').text = self.base_url
-            ET.SubElement(channel, 'lastBuildDate').text = datetime.now().isoformat()
-            
-            # Adicionar cada issue como um item
-            for issue in issues:
-                item = self._issue_to_xml(issue, channel)
-            
-            # Formatar o XML
-            rough_string = ET.tostring(rss, 'utf-8')
-            parsed = minidom.parseString(rough_string)
-            xml_str = parsed.toprettyxml(indent="  ")
-            
+            # Parâmetros da consulta
+            params = self.parametros_busca(jql_query, perfil)
+            self.zerar_medicao()
+
+            # O XML é escrito em streaming: cada página vira <item>s no arquivo assim
+            # que chega, então a memória não cresce com o número de issues
+            destino = output_file if output_file else io.BytesIO()
+            temporario = f"{output_file}.tmp" if output_file else None
+            total = 0
+            exportadas = 0
+            with ET.xmlfile(temporario or destino, encoding='utf-8') as xf:
+                xf.write_declaration()
+                with xf.element('rss', version='2.0'):
+                    with xf.element('channel'):
+                        for tag, texto in (
+                            ('title', 'JIRA Export'),
+                            ('description', f'JIRA Issues Export - Query: {jql_query}'),
+                            ('link', self.base_url),
+                            ('lastBuildDate', datetime.now().isoformat())
+                        ):
+                            elem = ET.Element(tag)
+                            elem.text = texto
+                            xf.write(elem, pretty_print=True)
+
+                        # Adicionar cada issue como um item
+                        for total, pagina in self.iterar_paginas(params, max_results, page_size, workers):
+                            for issue in pagina:
+                                xf.write(self._issue_to_xml(issue), pretty_print=True)
+                            xf.flush()
+                            exportadas += len(pagina)
+                            print(f"Exportadas {exportadas} de {total} issues...")
+
+            print(f"Encontradas {total} issues. Exportadas {exportadas} para XML.")
+            medicao = self.estatisticas_paginas()
+            print(f"Perfil '{perfil}': {medicao['paginas']} páginas, {medicao['kb_rede_por_pagina']:.1f} KB na rede "
+                  f"({medicao['kb_json_por_pagina']:.1f} KB de JSON) e {medicao['ms_por_pagina']:.0f} ms por página")
+
             # Salvar em arquivo se especificado
             if output_file:
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    f.write(xml_str)
+                os.replace(temporario, output_file)
                 print(f"XML salvo em: {output_file}")
-            
-            return xml_str
+                return output_file
+
+            return destino.getvalue().decode('utf-8')
             
         except Exception as e:
             print(f"Erro ao processar consulta JQL: {str(e)}")
+            if output_file and os.path.exists(f"{output_file}.tmp"):
+                os.remove(f"{output_file}.tmp")
             return None
     
-    def _issue_to_xml(self, issue, parent_element):
-        """Converte uma issue do JIRA para XML"""
-        item = ET.SubElement(parent_element, 'item')
+    def _issue_to_xml(self, issue, parent_element=None):
+        """Converte uma issue do JIRA para XML (um <item> solto se não houver parent_element)"""
+        if parent_element is None:
+            item = ET.Element('item')
+        else:
+            item = ET.SubElement(parent_element, 'item')
         
         # Campos básicos
-        ET.SubElement(item, 'title').text = f"[{issue['key']}] {issue['fields'].get('summary', '')}"
+        ET.SubElement(item, 'title').text = _xml_seguro(f"[{issue['key']}] {issue['fields'].get('summary', '')}")
         ET.SubElement(item, 'link').text = f"{self.base_url}/browse/{issue['key']}"
         
         # Project
@@ -140,13 +317,15 @@ class JiraXMLExporter:
         # Description
         description = issue['fields'].get('description', '')
         if description:
-            # Para preservar formatação HTML se existir
+            # Para preservar formatação HTML se existir (seção CDATA de verdade;
+            # "]]>" não pode aparecer dentro dela, então nesse caso vai escapado)
             desc_elem = ET.SubElement(item, 'description')
-            desc_elem.text = f"<![CDATA[{description}]]>"
+            description = _xml_seguro(description)
+            desc_elem.text = ET.CDATA(description) if ']]>' not in description else description
         else:
             ET.SubElement(item, 'description').text = ''
         
-        ET.SubElement(item, 'environment').text = issue['fields'].get('environment', '')
+        ET.SubElement(item, 'environment').text = _xml_seguro(issue['fields'].get('environment', ''))
         
         # Key
         key_elem = ET.SubElement(item, 'key')
@@ -154,7 +333,7 @@ class JiraXMLExporter:
         key_elem.text = issue['key']
         
         # Summary
-        ET.SubElement(item, 'summary').text = issue['fields'].get('summary', '')
+        ET.SubElement(item, 'summary').text = _xml_seguro(issue['fields'].get('summary', ''))
         
         # Issue Type
         issue_type = issue['fields'].get('issuetype', {})
@@ -241,7 +420,7 @@ class JiraXMLExporter:
                     comment_elem.set('id', comment.get('id', ''))
                     comment_elem.set('author', comment.get('author', {}).get('displayName', ''))
                     comment_elem.set('created', comment.get('created', ''))
-                    comment_elem.text = comment.get('body', '')
+                    comment_elem.text = _xml_seguro(comment.get('body', ''))
         
         # TODO: Adicionar mais campos conforme necessário
         
@@ -254,7 +433,13 @@ def main():
     parser.add_argument('--api-token', required=True, help='Token de API do JIRA')
     parser.add_argument('--jql', required=True, help='Consulta JQL para buscar issues')
     parser.add_argument('--output', help='Arquivo de saída XML (opcional)')
-    parser.add_argument('--max-results', type=int, default=100, help='Número máximo de resultados (padrão: 100)')
+    parser.add_argument('--max-results', type=int, default=100, help='Número máximo de resultados, 0 = todos (padrão: 100)')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help=f'Issues por página (padrão: {PAGE_SIZE})')
+    parser.add_argument('--workers', type=int, default=WORKERS, help=f'Páginas buscadas em paralelo (padrão: {WORKERS})')
+    parser.add_argument('--fields', choices=list(PERFIS_CAMPOS), default=FIELD_PROFILE,
+                        help=f'Perfil de campos pedidos ao JIRA (padrão: {FIELD_PROFILE})')
+    parser.add_argument('--comparar-perfis', action='store_true',
+                        help='Só mede bytes e latência por página em cada perfil de campos e sai')
     
     args = parser.parse_args()
     
@@ -271,11 +456,25 @@ def main():
         print("Não foi possível conectar ao JIRA. Verifique suas credenciais e URL.")
         sys.exit(1)
     
+    if args.comparar_perfis:
+        resultados = exporter.comparar_perfis(args.jql, page_size=args.page_size)
+        base = resultados['full']
+        print(f"{'Perfil':<10}{'KB rede':>10}{'KB JSON':>10}{'ms':>8}{'Economia (rede)':>18}{'Economia (ms)':>15}")
+        for perfil, m in resultados.items():
+            economia_kb = 1 - m['kb_rede_por_pagina'] / base['kb_rede_por_pagina'] if base['kb_rede_por_pagina'] else 0.0
+            economia_ms = 1 - m['ms_por_pagina'] / base['ms_por_pagina'] if base['ms_por_pagina'] else 0.0
+            print(f"{perfil:<10}{m['kb_rede_por_pagina']:>10.1f}{m['kb_json_por_pagina']:>10.1f}{m['ms_por_pagina']:>8.0f}"
+                  f"{economia_kb:>17.0%}{economia_ms:>15.0%}")
+        return
+
     # Executar consulta e gerar XML
     xml_output = exporter.jql_to_xml(
         jql_query=args.jql,
         max_results=args.max_results,
-        output_file=args.output
+        output_file=args.output,
+        page_size=args.page_size,
+        workers=args.workers,
+        perfil=args.fields
     )
     
     if xml_output:
@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from travas import ESTADO_DIR, caminho_estado, trava_ingestao
+
+# Quantos jobs finalizados ficam guardados para consulta em /jobs/<id>
+MAX_JOBS_FINALIZADOS = 100
+# Intervalo mínimo entre gravações do progresso de um job no arquivo
+JOB_SALVAR_SEGUNDOS = float(os.getenv("JOB_SALVAR_SEGUNDOS", 0.5))
+PADRAO_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+# Campos gravados no arquivo do job (o resto, como a exceção, só existe no processo dele)
+CAMPOS_PERSISTIDOS = (
+    "id", "collection", "status", "etapa", "feitos", "total", "inicio_etapa", "etapas",
+    "criado_em", "finalizado_em", "resultado", "erro"
+)
+
+
+def _arquivo_job(job_id):
+    return caminho_estado(f"job-{job_id}.json")
+
+
+def _arquivo_ativo(collection):
+    return caminho_estado(f"job-ativo-{collection}")
+
+
+def _gravar(caminho, conteudo):
+    # O os.replace troca o arquivo inteiro: quem lê nunca vê um JSON pela metade
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        f.write(conteudo)
+    os.replace(temporario, caminho)
+
+
+class JobIngestao:
+    """Estado de uma ingestão rodando em background.
+
+    O estado também vai para um arquivo em ESTADO_DIR (ver salvar), para que
+    qualquer worker responda o /jobs/<id>, não só o que iniciou o job.
+    """
+
+    def __init__(self, collection):
+        self.id = uuid.uuid4().hex
+        self.collection = collection
+        self.status = "queued"  # queued | running | done | error
+        self.etapa = None
+        self.feitos = 0
+        self.total = None
+        self.inicio_etapa = None
+        # etapa -> {"inicio", "feitos", "total"}: o pipeline avança várias etapas ao mesmo tempo
+        self.etapas = {}
+        self.criado_em = time.time()
+        self.finalizado_em = None
+        self.resultado = None
+        self.erro = None
+        self.excecao = None
+        self.concluido = threading.Event()
+        self._lock = threading.Lock()
+        self._salvo_em = 0.0
+
+    @classmethod
+    def carregar(cls, job_id):
+        """Job lido do arquivo gravado pelo processo que o executa, ou None."""
+        try:
+            with open(_arquivo_job(job_id), encoding="utf-8") as f:
+                dados = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        job = cls(dados["collection"])
+        for campo in CAMPOS_PERSISTIDOS:
+            setattr(job, campo, dados.get(campo))
+        if job.status in ("done", "error"):
+            job.concluido.set()
+        return job
+
+    def salvar(self, forcar=True):
+        """Grava o estado no arquivo do job; sem `forcar`, no máximo a cada JOB_SALVAR_SEGUNDOS."""
+        with self._lock:
+            agora = time.time()
+            if not forcar and agora - self._salvo_em < JOB_SALVAR_SEGUNDOS:
+                return
+            self._salvo_em = agora
+            conteudo = json.dumps({campo: getattr(self, campo) for campo in CAMPOS_PERSISTIDOS}, ensure_ascii=False)
+        _gravar(_arquivo_job(self.id), conteudo)
+
+    def atualizar(self, etapa, feitos, total=None):
+        """Callback de progresso passado para o criar_db."""
+        with self._lock:
+            info = self.etapas.get(etapa)
+            if info is None:
+                info = self.etapas[etapa] = {"inicio": time.time()}
+            info["feitos"] = feitos
+            info["total"] = total
+            self.etapa = etapa
+            self.inicio_etapa = info["inicio"]
+            self.feitos = feitos
+            self.total = total
+        self.salvar(forcar=False)
+
+    def _vazao(self, inicio, feitos, total):
+        """(throughput, eta) de uma etapa; None enquanto não há como estimar."""
+        if not inicio or self.status != "running":
+            return None, None
+        decorrido = time.time() - inicio
+        if decorrido <= 0 or not feitos:
+            return None, None
+        throughput = feitos / decorrido
+        eta = max(total - feitos, 0) / throughput if total else None
+        return throughput, eta
+
+    def para_dict(self):
+        with self._lock:
+            throughput, eta = self._vazao(self.inicio_etapa, self.feitos, self.total)
+            etapas = {}
+            for nome, info in self.etapas.items():
+                throughput_etapa, eta_etapa = self._vazao(info["inicio"], info["feitos"], info["total"])
+                etapas[nome] = {
+                    "done": info["feitos"],
+                    "total": info["total"],
+                    "throughput": throughput_etapa,
+                    "eta_seconds": eta_etapa
+                }
+            return {
+                "id": self.id,
+                "collection": self.collection,
+                "status": self.status,
+                "stage": self.etapa,
+                "done": self.feitos,
+                "total": self.total,
+                "throughput": throughput,
+                "eta_seconds": eta,
+                "stages": etapas,
+                "elapsed_seconds": (self.finalizado_em or time.time()) - self.criado_em,
+                "result": self.resultado,
+                "error": self.erro
+            }
+
+
+class GerenciadorJobs:
+    """Registra os jobs e garante uma única ingestão por collection.
+
+    A exclusividade vale entre processos (trava em arquivo, ver travas.py):
+    com vários workers do gunicorn, só um deles reindexa a collection por
+    vez. O estado dos jobs fica em arquivos em ESTADO_DIR, então qualquer
+    worker encontra um job (e o ativo de cada collection) iniciado por outro.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._ativos = {}
+        self._travas = {}
+        self._lock = threading.Lock()
+
+    def ativo(self, collection):
+        with self._lock:
+            return self._ativos.get(collection)
+
+    def _ativo_em_arquivo(self, collection):
+        """Job em andamento na collection segundo o arquivo, ou None.
+
+        Só é consultado quando a trava está com outro processo: um arquivo
+        deixado por um processo que morreu não bloqueia nada.
+        """
+        try:
+            with open(_arquivo_ativo(collection), encoding="utf-8") as f:
+                job_id = f.read().strip()
+        except FileNotFoundError:
+            return None
+        job = self.obter(job_id)
+        if job is None or job.status not in ("queued", "running"):
+            return None
+        return job
+
+    def obter(self, job_id):
+        if not PADRAO_JOB_ID.match(job_id or ""):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        # O job do próprio processo está sempre atualizado; o de outro worker vem do arquivo
+        return job if job is not None else JobIngestao.carregar(job_id)
+
+    def iniciar(self, collection, funcao, **kwargs):
+        """Inicia `funcao(progresso=..., **kwargs)` numa thread.
+
+        Retorna (job, True) se o job foi criado, ou (job_ativo, False) se já
+        existe uma ingestão em andamento para a collection. O job_ativo pode
+        ter sido iniciado por outro processo; é None se ele não for encontrado
+        (ex: ingestão rodando pela linha de comando).
+        """
+        with self._lock:
+            ativo = self._ativos.get(collection)
+            if ativo is not None:
+                return ativo, False
+            trava = self._travas.setdefault(collection, trava_ingestao(collection))
+            adquirida = trava.adquirir(bloquear=False)
+            if adquirida:
+                job = JobIngestao(collection)
+                self._jobs[job.id] = job
+                self._ativos[collection] = job
+                self._podar()
+        if not adquirida:
+            return self._ativo_em_arquivo(collection), False
+        job.salvar()
+        _gravar(_arquivo_ativo(collection), job.id)
+        thread = threading.Thread(target=self._executar, args=(job, funcao, kwargs), daemon=True)
+        thread.start()
+        return job, True
+
+    def _executar(self, job, funcao, kwargs):
+        job.status = "running"
+        job.salvar()
+        try:
+            resultado = funcao(progresso=job.atualizar, **kwargs)
+            if resultado is None:
+                job.erro = "Indexação abortada (veja o log do backend)"
+                job.status = "error"
+            else:
+                job.resultado = resultado
+                job.status = "done"
+        except Exception as e:
+            job.erro = str(e)
+            job.excecao = e
+            job.status = "error"
+        finally:
+            job.finalizado_em = time.time()
+            job.salvar()
+            with self._lock:
+                self._ativos.pop(job.collection, None)
+                self._travas[job.collection].liberar()
+            job.concluido.set()
+            self._podar_arquivos()
+
+    def _podar(self):
+        finalizados = [j for j in self._jobs.values() if j.finalizado_em is not None]
+        excesso = len(finalizados) - MAX_JOBS_FINALIZADOS
+        if excesso > 0:
+            finalizados.sort(key=lambda j: j.finalizado_em)
+            for job in finalizados[:excesso]:
+                del self._jobs[job.id]
+
+    def _podar_arquivos(self):
+        # Arquivos de jobs de todos os processos; os mais antigos já terminaram
+        # (só há um job em andamento por collection, e ele grava sempre)
+        arquivos = []
+        for nome in os.listdir(ESTADO_DIR):
+            if nome.startswith("job-") and nome.endswith(".json"):
+                caminho = os.path.join(ESTADO_DIR, nome)
+                try:
+                    arquivos.append((os.stat(caminho).st_mtime, caminho))
+                except FileNotFoundError:
+                    continue
+        arquivos.sort()
+        for _, caminho in arquivos[:max(len(arquivos) - MAX_JOBS_FINALIZADOS, 0)]:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
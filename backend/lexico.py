@@ -0,0 +1,63 @@
+import os
+import re
+import zlib
+from collections import Counter
+from qdrant_client.models import SparseVector
+
+# Nome do vetor esparso (BM25) na collection; o IDF é aplicado pelo Qdrant (Modifier.IDF)
+SPARSE_VECTOR_NAME = "bm25"
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# Tamanho médio (em tokens) dos chunks; fixo para que reindexações incrementais
+# não mudem o peso dos chunks que já estão na base
+BM25_AVGDL = float(os.getenv("BM25_AVGDL", 600))
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# Palavras e identificadores compostos: hostnames, códigos de erro, chaves (srv-app01.dominio, ORA-00942)
+PADRAO_TOKEN = re.compile(r"\w+(?:[-./:]\w+)*")
+
+
+def tokenizar(texto_norm):
+    """Quebra o texto normalizado em termos, mantendo identificadores inteiros e suas partes."""
+    termos = []
+    for token in PADRAO_TOKEN.findall(texto_norm):
+        termos.append(token)
+        partes = re.split(r"[-./:]", token)
+        if len(partes) > 1:
+            termos.extend(p for p in partes if p)
+    return termos
+
+
+def _indice(termo):
+    return zlib.crc32(termo.encode("utf-8")) & 0x7FFFFFFF
+
+
+def vetor_esparso_documento(texto_norm):
+    """Pesos de TF saturado do BM25 por termo (o IDF fica por conta do Qdrant)."""
+    frequencias = Counter(_indice(t) for t in tokenizar(texto_norm))
+    tamanho = sum(frequencias.values())
+    normalizacao = BM25_K1 * (1 - BM25_B + BM25_B * tamanho / BM25_AVGDL)
+    indices = list(frequencias)
+    valores = [tf * (BM25_K1 + 1) / (tf + normalizacao) for tf in frequencias.values()]
+    return SparseVector(indices=indices, values=valores)
+
+
+def vetor_esparso_consulta(texto_norm):
+    indices = sorted({_indice(t) for t in tokenizar(texto_norm)})
+    return SparseVector(indices=indices, values=[1.0] * len(indices))
+
+
+def fundir_rrf(listas, limite, k=RRF_K):
+    """Reciprocal rank fusion.
+
+    `listas` é um dict {fonte: [pontos ordenados]}. Retorna até `limite`
+    tuplas (ponto, score_rrf, {fonte: score_original}) em ordem decrescente.
+    """
+    fundidos = {}
+    for fonte, pontos in listas.items():
+        for rank, ponto in enumerate(pontos, 1):
+            item = fundidos.setdefault(ponto.id, [ponto, 0.0, {}])
+            item[1] += 1.0 / (k + rank)
+            item[2][fonte] = ponto.score
+    ordenados = sorted(fundidos.values(), key=lambda item: item[1], reverse=True)
+    return [tuple(item) for item in ordenados[:limite]]
@@ -1,14 +1,12 @@
 import os
-from qdrant_client import QdrantClient
+from qdrant_conexao import obter_cliente
 from qdrant_client.http.models import PointStruct
 
 # Configurações
-QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
-QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION", "jira")
 
 # Conecta ao Qdrant
-client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+client = obter_cliente()
 
 # Busca todos os pontos (chunks) da collection
 try:
@@ -41,6 +39,8 @@ try:
             print(f"Texto: {payload.get('text', '[sem texto]')}")
             # Exibe overlaps se existirem
             overlap = payload.get('overlap')
+            if 'overlap_end' in payload:
+                overlap = payload.get('text_raw', '')[:payload['overlap_end']]
             if overlap is not None:
                 print(f"Overlap: {overlap}")
             else:
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Relatório de memória do master e dos workers do gunicorn (Linux, via /proc)
+"""
+import argparse
+import os
+import sys
+
+
+def ler_memoria(pid):
+    """RSS, PSS e memória privada/compartilhada do processo, em MB."""
+    campos = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for linha in f:
+            partes = linha.split()
+            if len(partes) >= 2 and partes[0].endswith(":") and partes[1].isdigit():
+                campos[partes[0][:-1]] = int(partes[1]) / 1024
+    return {
+        "pid": pid,
+        "rss_mb": campos.get("Rss", 0.0),
+        "pss_mb": campos.get("Pss", 0.0),
+        "privada_mb": campos.get("Private_Clean", 0.0) + campos.get("Private_Dirty", 0.0),
+        "compartilhada_mb": campos.get("Shared_Clean", 0.0) + campos.get("Shared_Dirty", 0.0)
+    }
+
+
+def filhos(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mostra a memória do master do gunicorn e de cada worker')
+    parser.add_argument('--pid', type=int, help='PID do master (padrão: lido de --pidfile)')
+    parser.add_argument('--pidfile', default='gunicorn.pid', help='Arquivo de PID do gunicorn (padrão: gunicorn.pid)')
+    args = parser.parse_args()
+
+    pid = args.pid
+    if pid is None:
+        if not os.path.exists(args.pidfile):
+            print(f"Erro: informe --pid ou um --pidfile existente ({args.pidfile})")
+            sys.exit(1)
+        with open(args.pidfile) as f:
+            pid = int(f.read().strip())
+
+    processos = [("master", pid)] + [("worker", p) for p in filhos(pid)]
+    print(f"{'Processo':<10}{'PID':>8}{'RSS (MB)':>12}{'PSS (MB)':>12}{'Privada (MB)':>14}{'Compart. (MB)':>15}")
+    total_pss = 0.0
+    for nome, p in processos:
+        m = ler_memoria(p)
+        total_pss += m["pss_mb"]
+        print(f"{nome:<10}{p:>8}{m['rss_mb']:>12.1f}{m['pss_mb']:>12.1f}{m['privada_mb']:>14.1f}{m['compartilhada_mb']:>15.1f}")
+    # PSS divide as páginas compartilhadas entre os processos: a soma é o uso real
+    print(f"\nTotal real (soma do PSS): {total_pss:.1f} MB em {len(processos)} processos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+Pipeline de ingestão em estágios para o criar_db.
+
+Em vez de rodar cada fase até o fim antes da próxima, os estágios rodam ao
+mesmo tempo, ligados por filas limitadas:
+
+    leitura do XML -> chunking/normalização -> seleção (hash) -> embedding -> upsert
+       (thread)        (processos)              (thread)         (processos)  (threads)
+
+Cada fila guarda no máximo PIPELINE_FILA_MAX lotes: se um estágio atrasa,
+os anteriores ficam bloqueados no put (backpressure) e a memória não cresce
+com o tamanho do export. Chunking e embedding são CPU e rodam em pools de
+processos; o upsert é rede e roda em threads, enquanto os próximos lotes
+ainda estão sendo embedados.
+
+O pipeline roda num processo à parte, com este módulo como __main__
+(criar_db_pipeline): os workers usam spawn (PIPELINE_START_METHOD) e
+reimportam o __main__ de quem os cria, que a partir da API seria o api.py
+inteiro (modelo spaCy, cliente do Qdrant, trava do storage local). Aqui eles
+só importam este módulo. Progresso e resultado voltam por linhas no stdout.
+Cada worker de embedding carrega o modelo uma vez; a tabela de vetores é um
+memmap (ver embeddings.py), então as páginas são compartilhadas entre eles.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from langchain.schema import Document
+from lxml import etree
+from qdrant_client.models import Batch
+from cria_db import (
+    BASE_DIR, COLLECTION_NAME, XML_PATH, REINDEX_INCREMENTAL, _sem_progresso, calcular_overlaps, carregar_documentos_xml,
+    carregar_hashes, criar_separador, gerar_chunks, hash_do_chunk, id_do_chunk, montar_payload, normalizar_texto,
+    obsoletos_do_xml, preparar_collection, remover_pontos, vai_recriar
+)
+from embeddings import EMBEDDING_MODEL, criar_embedder
+from lexico import SPARSE_VECTOR_NAME, vetor_esparso_documento
+from qdrant_conexao import obter_cliente
+
+CPUS = os.cpu_count() or 2
+PIPELINE_CHUNK_WORKERS = int(os.getenv("PIPELINE_CHUNK_WORKERS", max(1, CPUS // 4)))
+PIPELINE_EMBED_WORKERS = int(os.getenv("PIPELINE_EMBED_WORKERS", max(1, CPUS // 2)))
+PIPELINE_UPSERT_WORKERS = int(os.getenv("PIPELINE_UPSERT_WORKERS", 2))
+# Tamanho máximo de cada fila entre estágios, em lotes
+PIPELINE_FILA_MAX = int(os.getenv("PIPELINE_FILA_MAX", 8))
+PIPELINE_DOCS_POR_LOTE = int(os.getenv("PIPELINE_DOCS_POR_LOTE", 64))
+PIPELINE_CHUNKS_POR_LOTE = int(os.getenv("PIPELINE_CHUNKS_POR_LOTE", 256))
+PIPELINE_START_METHOD = os.getenv("PIPELINE_START_METHOD", "spawn")
+# De quantos em quantos segundos a vazão dos estágios é impressa
+PIPELINE_RELATORIO_SEGUNDOS = float(os.getenv("PIPELINE_RELATORIO_SEGUNDOS", 10))
+
+_FIM = object()
+# Linhas do stdout do processo do pipeline lidas pelo processo pai
+PREFIXO_PROGRESSO = "@@progresso "
+PREFIXO_RESULTADO = "@@resultado "
+
+# --- Funções dos workers (rodam nos processos dos pools) ---
+
+_separador = None
+_embedder = None
+
+
+def _chunkar_lote(documentos):
+    """(texto, issue_key) -> registros (id, hash, chunk, overlap, texto_norm) de todos os chunks."""
+    global _separador
+    if _separador is None:
+        _separador = criar_separador()
+    registros = []
+    for texto, issue_key in documentos:
+        documento = Document(page_content=texto, metadata={"issue_key": issue_key})
+        chunks = list(gerar_chunks([documento], _separador))
+        for chunk, overlap in zip(chunks, calcular_overlaps(chunks)):
+            registros.append((
+                id_do_chunk(chunk), hash_do_chunk(chunk, overlap), chunk, overlap,
+                normalizar_texto(chunk.page_content)
+            ))
+    return registros
+
+
+def _iniciar_embedder():
+    global _embedder
+    _embedder = criar_embedder()
+
+
+def _dimensao():
+    return _embedder.dim
+
+
+def _embedar_lote(textos_norm):
+    return _embedder.embed_lote(textos_norm), [vetor_esparso_documento(t) for t in textos_norm]
+
+
+def _textos_do_lote(registros):
+    # Só o texto normalizado vai para o processo de embedding; o resto do registro fica aqui
+    return [registro[4] for registro in registros]
+
+
+# --- Orquestração (processo principal) ---
+
+class PipelineIngestao:
+    """Liga os estágios por filas limitadas e conta a vazão de cada um."""
+
+    def __init__(self, client, collection_name, hashes_existentes, origens, progresso=_sem_progresso,
+                 total_documentos=None, chunk_workers=PIPELINE_CHUNK_WORKERS, embed_workers=PIPELINE_EMBED_WORKERS,
+                 upsert_workers=PIPELINE_UPSERT_WORKERS, fila_max=PIPELINE_FILA_MAX):
+        self.client = client
+        self.collection_name = collection_name
+        self.hashes_existentes = hashes_existentes
+        self.origens = origens
+        self.progresso = progresso
+        self.total_documentos = total_documentos
+        self.chunk_workers = chunk_workers
+        self.embed_workers = embed_workers
+        self.upsert_workers = upsert_workers
+        self.fila_documentos = queue.Queue(maxsize=fila_max)
+        self.fila_chunks = queue.Queue(maxsize=fila_max)
+        self.fila_embed = queue.Queue(maxsize=fila_max)
+        self.fila_upsert = queue.Queue(maxsize=fila_max)
+        self.ids_vistos = set()
+        self.contadores = {"documentos": 0, "chunks": 0, "pendentes": 0, "embedados": 0, "enviados": 0}
+        # Só depois da seleção se sabe quantos chunks vão para embedding/upsert
+        self.selecao_concluida = False
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self.erro = None
+
+    def _contar(self, campo, n):
+        with self._lock:
+            self.contadores[campo] += n
+
+    def _falhar(self, erro):
+        with self._lock:
+            if self.erro is None:
+                self.erro = erro
+        self._parar.set()
+
+    def _colocar(self, fila, item):
+        # put com timeout para não ficar preso se outro estágio falhou
+        while not self._parar.is_set():
+            try:
+                fila.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _tirar(self, fila):
+        while not self._parar.is_set():
+            try:
+                return fila.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return _FIM
+
+    def _em_paralelo(self, entrada, saida, executor, funcao, max_em_voo, ao_concluir=None, argumento=None):
+        """Roda `funcao` em cada lote da entrada no executor, com no máximo
+        `max_em_voo` lotes pendentes, e entrega os resultados em ordem na saída.
+
+        Com `argumento`, `funcao` recebe só `argumento(lote)` e o resultado
+        entregue é (lote, retorno): o lote não atravessa o executor.
+        """
+        em_voo = deque()
+
+        def entregar():
+            lote, futuro = em_voo.popleft()
+            resultado = futuro.result()
+            if argumento:
+                resultado = (lote, resultado)
+            if ao_concluir:
+                ao_concluir(resultado)
+            return saida is None or self._colocar(saida, resultado)
+
+        while True:
+            lote = self._tirar(entrada)
+            if lote is _FIM:
+                break
+            if len(em_voo) >= max_em_voo and not entregar():
+                return
+            em_voo.append((lote, executor.submit(funcao, argumento(lote) if argumento else lote)))
+        while em_voo and not self._parar.is_set():
+            if not entregar():
+                return
+        if saida is not None:
+            self._colocar(saida, _FIM)
+
+    def _thread(self, nome, alvo, *args):
+        def executar():
+            try:
+                alvo(*args)
+            except Exception as e:
+                self._falhar(e)
+        thread = threading.Thread(target=executar, name=f"pipeline-{nome}", daemon=True)
+        thread.start()
+        return thread
+
+    # Estágios
+
+    def _ler(self, xml_path):
+        lote = []
+        for documento in carregar_documentos_xml(xml_path):
+            lote.append((documento.page_content, documento.metadata["issue_key"]))
+            if len(lote) >= PIPELINE_DOCS_POR_LOTE:
+                self._contar("documentos", len(lote))
+                if not self._colocar(self.fila_documentos, lote):
+                    return
+                lote = []
+        if lote:
+            self._contar("documentos", len(lote))
+            self._colocar(self.fila_documentos, lote)
+        self._colocar(self.fila_documentos, _FIM)
+
+    def _selecionar(self):
+        # Guarda todos os IDs (para achar os obsoletos) e só deixa passar os chunks novos/alterados
+        lote = []
+        while True:
+            registros = self._tirar(self.fila_chunks)
+            if registros is _FIM:
+                break
+            self._contar("chunks", len(registros))
+            for registro in registros:
+                id_, hash_chunk = registro[0], registro[1]
+                self.ids_vistos.add(id_)
+                if self.hashes_existentes.get(id_) != hash_chunk:
+                    lote.append(registro)
+                    if len(lote) >= PIPELINE_CHUNKS_POR_LOTE:
+                        self._contar("pendentes", len(lote))
+                        if not self._colocar(self.fila_embed, lote):
+                            return
+                        lote = []
+        if lote:
+            self._contar("pendentes", len(lote))
+            if not self._colocar(self.fila_embed, lote):
+                return
+        with self._lock:
+            self.selecao_concluida = True
+        self._colocar(self.fila_embed, _FIM)
+
+    def _enviar_lote(self, resultado):
+        registros, (vectors, esparsos) = resultado
+        self.client.upsert(
+            collection_name=self.collection_name,
+            points=Batch(
+                ids=[registro[0] for registro in registros],
+                vectors={"": vectors.tolist(), SPARSE_VECTOR_NAME: esparsos},
+                payloads=[
+                    montar_payload(chunk, texto_norm, overlap, hash_chunk, self.origens.get(id_))
+                    for id_, hash_chunk, chunk, overlap, texto_norm in registros
+                ]
+            ),
+            wait=True
+        )
+        return len(registros)
+
+    def relatar_progresso(self):
+        """Passa ao `progresso` a contagem de todas as etapas, da primeira à última:
+        a última chamada (upsert) é a etapa corrente, com total assim que a seleção termina."""
+        with self._lock:
+            contadores = dict(self.contadores)
+            selecao_concluida = self.selecao_concluida
+        pendentes = contadores["pendentes"] if selecao_concluida else None
+        self.progresso("parse", contadores["documentos"], self.total_documentos)
+        self.progresso("chunk", contadores["chunks"], contadores["chunks"] if selecao_concluida else None)
+        self.progresso("embed", contadores["embedados"], pendentes)
+        self.progresso("upsert", contadores["enviados"], pendentes)
+
+    def relatorio(self, decorrido):
+        with self._lock:
+            contadores = dict(self.contadores)
+        return " | ".join(f"{campo}: {n} ({n / max(decorrido, 1e-9):.0f}/s)" for campo, n in contadores.items())
+
+    def executar(self, xml_path, pool_embed):
+        contexto = multiprocessing.get_context(PIPELINE_START_METHOD)
+        inicio = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.chunk_workers, mp_context=contexto) as pool_chunk, \
+                ThreadPoolExecutor(max_workers=self.upsert_workers, thread_name_prefix="upsert") as pool_upsert:
+            threads = [
+                self._thread("leitura", self._ler, xml_path),
+                self._thread("chunk", self._em_paralelo, self.fila_documentos, self.fila_chunks,
+                             pool_chunk, _chunkar_lote, self.chunk_workers * 2),
+                self._thread("selecao", self._selecionar),
+                self._thread("embed", self._em_paralelo, self.fila_embed, self.fila_upsert,
+                             pool_embed, _embedar_lote, self.embed_workers * 2,
+                             lambda resultado: self._contar("embedados", len(resultado[0])), _textos_do_lote),
+                self._thread("upsert", self._em_paralelo, self.fila_upsert, None,
+                             pool_upsert, self._enviar_lote, self.upsert_workers * 2,
+                             lambda n: self._contar("enviados", n)),
+            ]
+            proximo_relatorio = inicio + PIPELINE_RELATORIO_SEGUNDOS
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+                    self.relatar_progresso()
+                    if time.perf_counter() >= proximo_relatorio:
+                        print(f"[pipeline] {self.relatorio(time.perf_counter() - inicio)}")
+                        proximo_relatorio += PIPELINE_RELATORIO_SEGUNDOS
+            if self.erro is not None:
+                pool_chunk.shutdown(wait=True, cancel_futures=True)
+                raise self.erro
+        self.relatar_progresso()
+        duracao = time.perf_counter() - inicio
+        print(f"[pipeline] concluído em {duracao:.1f}s | {self.relatorio(duracao)}")
+        return duracao
+
+
+def criar_db_pipeline(xml_path=XML_PATH, incremental=REINDEX_INCREMENTAL, progresso=_sem_progresso):
+    """Mesmo contrato do criar_db (retorno e progresso), com os estágios sobrepostos.
+
+    Sobe o pipeline num processo python à parte (ver docstring do módulo) e
+    repassa o progresso que ele reporta.
+    """
+    comando = [
+        sys.executable, "-u", os.path.abspath(__file__), "--xml", xml_path,
+        "--incremental" if incremental else "--completo", "--relatar"
+    ]
+    resultado = None
+    with subprocess.Popen(comando, cwd=BASE_DIR, stdout=subprocess.PIPE, text=True, encoding="utf-8") as processo:
+        for linha in processo.stdout:
+            if linha.startswith(PREFIXO_PROGRESSO):
+                progresso(*json.loads(linha[len(PREFIXO_PROGRESSO):]))
+            elif linha.startswith(PREFIXO_RESULTADO):
+                resultado = json.loads(linha[len(PREFIXO_RESULTADO):])
+            else:
+                print(linha, end="")
+    if processo.returncode != 0:
+        print(f"Processo do pipeline terminou com código {processo.returncode}. Abortando.")
+        return
+    return resultado
+
+
+def _relatar(etapa, feitos, total=None):
+    print(PREFIXO_PROGRESSO + json.dumps([etapa, feitos, total]), flush=True)
+
+
+def executar_pipeline(xml_path=XML_PATH, incremental=REINDEX_INCREMENTAL, progresso=_sem_progresso):
+    """Corpo do criar_db_pipeline, no processo do pipeline."""
+    client = obter_cliente()
+    total_documentos = None
+    if vai_recriar(client, COLLECTION_NAME, incremental):
+        # Recriar apaga a base: antes disso o XML é lido inteiro, e um export
+        # truncado aborta aqui. Sem recriar nada é apagado antes do fim da
+        # leitura (os obsoletos só saem depois), então essa passada é dispensada
+        try:
+            total_documentos = sum(1 for _ in carregar_documentos_xml(xml_path))
+        except (etree.XMLSyntaxError, OSError):
+            print("XML inválido ou truncado; a base não foi alterada. Abortando.")
+            return
+        if not total_documentos:
+            print("Nenhum documento lido do XML. Abortando.")
+            return
+    contexto = multiprocessing.get_context(PIPELINE_START_METHOD)
+    with ProcessPoolExecutor(max_workers=PIPELINE_EMBED_WORKERS, mp_context=contexto,
+                             initializer=_iniciar_embedder) as pool_embed:
+        # O modelo só é carregado nos workers; a dimensão vem de um deles
+        try:
+            dim = pool_embed.submit(_dimensao).result()
+        except Exception as e:
+            print(f"Erro ao carregar modelo spaCy. Rode: python -m spacy download {EMBEDDING_MODEL}")
+            print(e)
+            return
+
+        incremental = preparar_collection(client, COLLECTION_NAME, dim, incremental)
+        origens = {}
+        hashes_existentes = carregar_hashes(client, COLLECTION_NAME, origens=origens) if incremental else {}
+
+        pipeline = PipelineIngestao(client, COLLECTION_NAME, hashes_existentes, origens, progresso, total_documentos)
+        try:
+            duracao = pipeline.executar(xml_path, pool_embed)
+        except Exception as e:
+            # Inclui erro de leitura do XML no meio do caminho: nada é removido
+            print(f"Erro na ingestão: {e}")
+            return
+
+    contadores = pipeline.contadores
+    if not contadores["chunks"]:
+        print("Nenhum chunk gerado a partir do XML. Abortando.")
+        return
+    obsoletos = obsoletos_do_xml(hashes_existentes, pipeline.ids_vistos, origens)
+    remover_pontos(client, COLLECTION_NAME, obsoletos)
+    print(f"Chunks novos/alterados: {contadores['pendentes']} | inalterados: "
+          f"{contadores['chunks'] - contadores['pendentes']} | removidos: {len(obsoletos)}")
+    return {
+        "chunks": contadores["chunks"],
+        "atualizados": contadores["enviados"],
+        "removidos": len(obsoletos),
+        "segundos": duracao
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexa o JIRA.xml no Qdrant com o pipeline de ingestão")
+    parser.add_argument("--xml", default=XML_PATH, help="Export XML do JIRA")
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument("--incremental", dest="incremental", action="store_true", default=REINDEX_INCREMENTAL,
+                      help="Só embeda os chunks novos ou alterados")
+    modo.add_argument("--completo", dest="incremental", action="store_false", help="Recria a collection")
+    parser.add_argument("--relatar", action="store_true",
+                        help="Progresso e resultado em linhas para o processo pai (uso do criar_db_pipeline)")
+    args = parser.parse_args()
+
+    resultado = executar_pipeline(args.xml, args.incremental, _relatar if args.relatar else _sem_progresso)
+    if args.relatar:
+        print(PREFIXO_RESULTADO + json.dumps(resultado), flush=True)
+
+
+if __name__ == "__main__":
+    main()
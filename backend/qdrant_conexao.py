@@ -0,0 +1,87 @@
+import os
+import threading
+import httpx
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+# Configurações
+# "server": Qdrant do docker-compose (REST ou gRPC); "local": base embutida em disco
+# (QDRANT_PATH); "memory": base embutida só em memória (CI/benchmarks)
+QDRANT_MODE = os.getenv("QDRANT_MODE", "server")
+QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
+QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+# gRPC evita serializar os vetores em JSON em cada busca/upsert
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "1") == "1"
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 30))
+QDRANT_POOL_SIZE = int(os.getenv("QDRANT_POOL_SIZE", 32))
+QDRANT_KEEPALIVE_SEGUNDOS = int(os.getenv("QDRANT_KEEPALIVE_SEGUNDOS", 30))
+QDRANT_PATH = os.getenv("QDRANT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectordb_local"))
+
+_cliente = None
+_lock = threading.Lock()
+
+
+def _parametros_servidor(prefer_grpc):
+    return dict(
+        host=QDRANT_HOST,
+        port=QDRANT_PORT,
+        grpc_port=QDRANT_GRPC_PORT,
+        prefer_grpc=prefer_grpc,
+        timeout=QDRANT_TIMEOUT,
+        # Pool HTTP (REST) com conexões reaproveitadas entre requisições
+        limits=httpx.Limits(
+            max_connections=QDRANT_POOL_SIZE,
+            max_keepalive_connections=QDRANT_POOL_SIZE,
+            keepalive_expiry=QDRANT_KEEPALIVE_SEGUNDOS
+        ),
+        grpc_options={
+            "grpc.keepalive_time_ms": QDRANT_KEEPALIVE_SEGUNDOS * 1000,
+            "grpc.keepalive_permit_without_calls": 1,
+            "grpc.max_send_message_length": 64 * 1024 * 1024,
+            "grpc.max_receive_message_length": 64 * 1024 * 1024
+        }
+    )
+
+
+def criar_cliente(modo=QDRANT_MODE, prefer_grpc=QDRANT_PREFER_GRPC):
+    """Cria um QdrantClient novo para o modo informado."""
+    if modo == "server":
+        return QdrantClient(**_parametros_servidor(prefer_grpc))
+    if modo == "local":
+        return QdrantClient(path=QDRANT_PATH)
+    if modo == "memory":
+        return QdrantClient(location=":memory:")
+    raise ValueError(f"QDRANT_MODE inválido: {modo}")
+
+
+def obter_cliente():
+    """Cliente compartilhado pelo processo.
+
+    Nos modos embutidos só pode existir uma instância por base (o modo local
+    trava o diretório e o modo memória some com a instância), então indexação
+    e consultas precisam usar o mesmo cliente.
+    """
+    global _cliente
+    with _lock:
+        if _cliente is None:
+            _cliente = criar_cliente()
+        return _cliente
+
+
+def reiniciar_cliente():
+    """Descarta o cliente compartilhado (ex: depois de um fork) e cria outro."""
+    global _cliente
+    with _lock:
+        _cliente = None
+    return obter_cliente()
+
+
+def criar_cliente_async(prefer_grpc=QDRANT_PREFER_GRPC):
+    """AsyncQdrantClient com a mesma configuração, só para o modo servidor.
+
+    Nos modos embutidos retorna None: a base já pertence ao cliente síncrono
+    do processo, que deve ser usado (em thread) no lugar.
+    """
+    if QDRANT_MODE != "server":
+        return None
+    return AsyncQdrantClient(**_parametros_servidor(prefer_grpc))
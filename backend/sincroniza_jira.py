@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Sincronização incremental do JIRA com a base vetorial.
+
+Para cada JQL guarda uma marca d'água (o maior `updated` já visto) e, nas
+execuções seguintes, busca só `updated >= marca`. As issues alteradas são
+re-chunkadas e enviadas como upsert: os IDs dos pontos são derivados da
+issue key (ver id_do_chunk), então só chunks com hash diferente são
+embedados de novo e os que sobraram da versão anterior da issue são
+apagados. Issues removidas ou que saíram do filtro da JQL não aparecem na
+busca incremental; de tempos em tempos (JIRA_SYNC_RECONCILIAR_HORAS) a
+lista completa de keys da JQL é comparada com os pontos marcados com a
+origem dessa JQL e os que sobraram são apagados.
+
+Para rodar (de dentro de backend/):
+    python sincroniza_jira.py --jql "project = PROJ"
+    python sincroniza_jira.py --jql "project = PROJ" --intervalo 300
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from qdrant_client.models import FieldCondition, Filter, MatchValue
+from cache import GeracaoCompartilhada
+from cria_db import (
+    BASE_DIR, COLLECTION_NAME, _sem_progresso, calcular_overlaps, carregar_hashes, criar_separador,
+    filtro_issues, gerar_chunks, hash_do_chunk, id_do_chunk, indexar_chunks, issue_para_documento,
+    preparar_collection, remover_pontos
+)
+from embeddings import criar_embedder
+from jiraxml_exporter import JIRA_CONFIG, PERFIS_CAMPOS, JiraXMLExporter
+from qdrant_conexao import obter_cliente
+from travas import trava_ingestao
+
+SYNC_STATE_PATH = os.getenv("JIRA_SYNC_STATE", os.path.join(BASE_DIR, "sync_jira.json"))
+SYNC_RECONCILIAR_HORAS = float(os.getenv("JIRA_SYNC_RECONCILIAR_HORAS", 24))
+# Folga aplicada à marca d'água: a JQL só aceita minutos, e relógios/fusos podem divergir
+SYNC_MARGEM_MINUTOS = int(os.getenv("JIRA_SYNC_MARGEM_MINUTOS", 1))
+SYNC_INTERVALO = int(os.getenv("JIRA_SYNC_INTERVALO", 300))
+# Só o que entra no texto indexado, mais o updated para a marca d'água
+CAMPOS_SYNC = PERFIS_CAMPOS["minimal"]["fields"] + ",updated"
+
+
+def criar_exportador():
+    return JiraXMLExporter(JIRA_CONFIG['url'], JIRA_CONFIG['email'], JIRA_CONFIG['api_token'])
+
+
+def origem_da_jql(jql):
+    """Identificador curto da JQL, gravado no payload "origem" dos pontos que ela criou."""
+    return "jql:" + hashlib.sha1(" ".join(jql.split()).encode("utf-8")).hexdigest()[:16]
+
+
+def filtro_origem(origem):
+    return Filter(must=[FieldCondition(key="origem", match=MatchValue(value=origem))])
+
+
+def sem_order_by(jql):
+    return re.sub(r"\s+order\s+by\s+.*$", "", jql.strip(), flags=re.IGNORECASE | re.DOTALL)
+
+
+def ler_data_jira(valor):
+    # Formato do JIRA: 2024-05-10T14:03:22.123-0300
+    return datetime.strptime(valor, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def filtrar_tipo(jql, issue_type):
+    """Restringe a JQL ao tipo de issue, mantendo o ORDER BY original."""
+    if not issue_type:
+        return jql
+    base = sem_order_by(jql)
+    ordem = jql.strip()[len(base):]
+    return f'({base}) AND issuetype = "{issue_type}"{ordem}'
+
+
+def jql_incremental(jql, watermark):
+    """JQL original restrita a `updated >= watermark` (menos a folga), em ordem de updated."""
+    base = sem_order_by(jql)
+    if watermark:
+        # A JQL usa o fuso do usuário, o mesmo em que o JIRA devolve o updated
+        desde = ler_data_jira(watermark) - timedelta(minutes=SYNC_MARGEM_MINUTOS)
+        base = f'({base}) AND updated >= "{desde:%Y/%m/%d %H:%M}"'
+    return f"{base} ORDER BY updated ASC"
+
+
+def ler_estado(caminho=SYNC_STATE_PATH):
+    if not os.path.exists(caminho):
+        return {}
+    with open(caminho, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def salvar_estado(estado, caminho=SYNC_STATE_PATH):
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(estado, f, ensure_ascii=False, indent=2)
+    os.replace(temporario, caminho)
+
+
+def indexar_issues(client, collection_name, embedder, issues, separador, origem=None, progresso=_sem_progresso):
+    """Upsert das issues na collection, por issue key.
+
+    Compara os hashes com os pontos que já existem para essas issues: só
+    chunks novos/alterados são embedados, e chunks que a issue não tem mais
+    são removidos.
+    """
+    documentos = [issue_para_documento(issue) for issue in issues]
+    if not documentos:
+        return {"chunks": 0, "atualizados": 0, "removidos": 0}
+    chunks = list(gerar_chunks(documentos, separador))
+    keys = {documento.metadata["issue_key"] for documento in documentos}
+    origens = {}
+    existentes = carregar_hashes(client, collection_name, filtro=filtro_issues(keys), origens=origens)
+
+    ids = [id_do_chunk(chunk) for chunk in chunks]
+    overlaps = calcular_overlaps(chunks)
+    hashes = [hash_do_chunk(chunk, overlap) for chunk, overlap in zip(chunks, overlaps)]
+    pendentes = [i for i, (id_, h) in enumerate(zip(ids, hashes)) if existentes.get(id_) != h]
+    obsoletos = set(existentes) - set(ids)
+
+    indexar_chunks(client, collection_name, embedder, chunks, pendentes, ids, overlaps, hashes, progresso, origem)
+    # Chunks inalterados que vieram de um XML passam a ser da origem: senão um
+    # reindex do XML sem a issue apagaria só parte dela
+    sem_origem = [ids[i] for i in set(range(len(ids))) - set(pendentes) if ids[i] not in origens]
+    if origem and sem_origem:
+        client.set_payload(collection_name=collection_name, payload={"origem": origem}, points=sem_origem, wait=True)
+    remover_pontos(client, collection_name, obsoletos)
+    return {"chunks": len(chunks), "atualizados": len(pendentes), "removidos": len(obsoletos)}
+
+
+def reconciliar(exportador, client, collection_name, jql, origem, batch_size=1000):
+    """Apaga os pontos da origem cujas issues não são mais retornadas pela JQL."""
+    params = {"jql": sem_order_by(jql), "fields": "key"}
+    keys_jira = set()
+    for _, pagina in exportador.iterar_paginas(params):
+        keys_jira.update(issue["key"] for issue in pagina)
+
+    obsoletos = []
+    offset = None
+    filtro = filtro_origem(origem)
+    while True:
+        pontos, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=filtro,
+            limit=batch_size,
+            offset=offset,
+            with_payload=["issue_key"],
+            with_vectors=False
+        )
+        obsoletos.extend(p.id for p in pontos if (p.payload or {}).get("issue_key") not in keys_jira)
+        if offset is None:
+            break
+    remover_pontos(client, collection_name, obsoletos)
+    print(f"Reconciliação: {len(keys_jira)} issues no JIRA, {len(obsoletos)} pontos removidos")
+    return len(obsoletos)
+
+
+def importar_jira(jql, max_results=None, issue_type=None, exportador=None, embedder=None, progresso=_sem_progresso):
+    """Importa o resultado de uma JQL direto para a collection, sem passar por XML.
+
+    Cada página do JSON do JIRA vira documentos, chunks, embeddings em lote
+    e upserts antes da próxima ser consumida (o exportador busca só algumas
+    páginas adiantadas), então a memória não cresce com o tamanho da JQL.
+    Retorna um dict com as estatísticas da importação.
+    """
+    exportador = exportador or criar_exportador()
+    embedder = embedder or criar_embedder()
+    client = obter_cliente()
+    preparar_collection(client, COLLECTION_NAME, embedder.dim, recriar_sem_esparso=False)
+    separador = criar_separador()
+
+    jql = filtrar_tipo(jql, issue_type)
+    params = {"jql": jql, "fields": CAMPOS_SYNC}
+    stats = {"total": 0, "issues": 0, "chunks": 0, "atualizados": 0, "removidos": 0}
+    inicio = time.perf_counter()
+    progresso("import", 0)
+    for total, pagina in exportador.iterar_paginas(params, max_results=max_results):
+        resultado = indexar_issues(client, COLLECTION_NAME, embedder, pagina, separador, origem_da_jql(jql))
+        stats["total"] = total
+        stats["issues"] += len(pagina)
+        for campo, valor in resultado.items():
+            stats[campo] += valor
+        progresso("import", stats["issues"], min(total, max_results) if max_results else total)
+    duracao = time.perf_counter() - inicio
+    print(f"Importação concluída em {duracao:.1f}s ({stats['issues'] / max(duracao, 1e-9):.1f} issues/s): {stats}")
+    return stats
+
+
+def sincronizar(jql, exportador=None, forcar_reconciliacao=False, embedder=None, progresso=_sem_progresso,
+                caminho_estado=SYNC_STATE_PATH):
+    """Sincroniza a JQL com a collection a partir da marca d'água salva.
+
+    Na primeira execução (sem marca) importa tudo. A marca é salva a cada
+    página, então uma execução interrompida continua de onde parou.
+    Retorna um dict com as estatísticas da sincronização.
+    """
+    exportador = exportador or criar_exportador()
+    embedder = embedder or criar_embedder()
+    client = obter_cliente()
+    preparar_collection(client, COLLECTION_NAME, embedder.dim, recriar_sem_esparso=False)
+    separador = criar_separador()
+
+    estado = ler_estado(caminho_estado)
+    origem = origem_da_jql(jql)
+    registro = estado.setdefault(origem, {"jql": jql})
+    watermark = registro.get("watermark")
+    if watermark and not client.count(collection_name=COLLECTION_NAME, count_filter=filtro_origem(origem)).count:
+        # Collection recriada (ou pontos apagados) desde a última sincronização: refaz do zero
+        print("Nenhum ponto desta JQL na collection; ignorando a marca d'água salva.")
+        watermark = None
+        registro.pop("watermark", None)
+    params = {"jql": jql_incremental(jql, watermark), "fields": CAMPOS_SYNC}
+    print(f"Sincronizando desde {watermark or 'o início'}: {params['jql']}")
+
+    stats = {"issues": 0, "chunks": 0, "atualizados": 0, "removidos": 0}
+    progresso("sync", 0)
+    for total, pagina in exportador.iterar_paginas(params):
+        resultado = indexar_issues(client, COLLECTION_NAME, embedder, pagina, separador, origem)
+        stats["issues"] += len(pagina)
+        for campo, valor in resultado.items():
+            stats[campo] += valor
+        # Páginas vêm em ordem de updated: a marca só avança
+        datas = [issue["fields"]["updated"] for issue in pagina if issue.get("fields", {}).get("updated")]
+        if datas:
+            maior = max(datas, key=ler_data_jira)
+            if not watermark or ler_data_jira(maior) > ler_data_jira(watermark):
+                watermark = maior
+                registro["watermark"] = watermark
+                salvar_estado(estado, caminho_estado)
+        progresso("sync", stats["issues"], total)
+
+    ultima = registro.get("reconciliado_em", 0)
+    if forcar_reconciliacao or time.time() - ultima >= SYNC_RECONCILIAR_HORAS * 3600:
+        progresso("reconcile", 0)
+        stats["removidos"] += reconciliar(exportador, client, COLLECTION_NAME, jql, origem)
+        registro["reconciliado_em"] = time.time()
+    registro["sincronizado_em"] = time.time()
+    salvar_estado(estado, caminho_estado)
+
+    stats["watermark"] = watermark
+    print(f"Sincronização concluída: {stats}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sincroniza incrementalmente uma consulta JQL com a base vetorial')
+    parser.add_argument('--jql', required=True, help='Consulta JQL a sincronizar')
+    parser.add_argument('--intervalo', type=int, default=0,
+                        help=f'Repete a cada N segundos (0 = uma vez; sugestão: {SYNC_INTERVALO})')
+    parser.add_argument('--reconciliar', action='store_true', help='Força a reconciliação de issues removidas')
+    args = parser.parse_args()
+
+    exportador = criar_exportador()
+    if not exportador.test_connection():
+        print("Não foi possível conectar ao JIRA. Verifique JIRA_URL, JIRA_EMAIL e JIRA_API_TOKEN.")
+        sys.exit(1)
+    while True:
+        try:
+            # Mesma trava e geração da API (ver travas.py e cache.py)
+            with trava_ingestao(COLLECTION_NAME):
+                try:
+                    sincronizar(args.jql, exportador, forcar_reconciliacao=args.reconciliar)
+                finally:
+                    GeracaoCompartilhada(f"geracao-{COLLECTION_NAME}").incrementar()
+        except Exception as e:
+            print(f"Erro na sincronização: {e}")
+            if not args.intervalo:
+                sys.exit(1)
+        if not args.intervalo:
+            return
+        args.reconciliar = False
+        time.sleep(args.intervalo)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Travas entre processos (workers do gunicorn e scripts de linha de comando)
+via fcntl.flock num arquivo em ESTADO_DIR.
+
+Sem fcntl (Windows) a trava vale só dentro do processo, que é como a API
+roda lá (run.bat sobe um único processo).
+"""
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ESTADO_DIR = os.getenv("ESTADO_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "estado"))
+
+
+def caminho_estado(nome):
+    os.makedirs(ESTADO_DIR, exist_ok=True)
+    return os.path.join(ESTADO_DIR, nome)
+
+
+class TravaArquivo:
+    """Trava exclusiva com nome, vista por todos os processos da máquina.
+
+    Pode ser liberada por outra thread (o job que roda em background libera
+    a trava que a requisição adquiriu).
+    """
+
+    def __init__(self, nome):
+        self.nome = nome
+        self._arquivo = None
+        self._lock = threading.Lock()
+
+    def adquirir(self, bloquear=True):
+        if not self._lock.acquire(blocking=bloquear):
+            return False
+        if fcntl is None:
+            return True
+        arquivo = open(caminho_estado(f"{self.nome}.lock"), "a+")
+        try:
+            fcntl.flock(arquivo, fcntl.LOCK_EX if bloquear else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            arquivo.close()
+            self._lock.release()
+            return False
+        self._arquivo = arquivo
+        return True
+
+    def liberar(self):
+        if self._arquivo is not None:
+            fcntl.flock(self._arquivo, fcntl.LOCK_UN)
+            self._arquivo.close()
+            self._arquivo = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.adquirir()
+        return self
+
+    def __exit__(self, *exc):
+        self.liberar()
+
+
+def trava_ingestao(collection):
+    """Trava que garante uma única ingestão por collection, entre todos os processos."""
+    return TravaArquivo(f"ingestao-{collection}")
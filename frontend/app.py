@@ -5,6 +5,7 @@ import json
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import tempfile
+import time
 
 # Configuração da página
 st.set_page_config(
@@ -20,6 +21,51 @@ Esta interface permite explorar o funcionamento do sistema RAG (Retrieval Augmen
 integrado com IA para análise e tomada de decisão baseada em dados do JIRA.
 """)
 
+def acompanhar_job(job_id, texto_inicial):
+    """Acompanha um job do backend (/jobs/<id>) com uma barra de progresso até ele terminar."""
+    progresso = st.progress(0.0, text=texto_inicial)
+    while True:
+        resposta_job = requests.get(f"http://localhost:5000/jobs/{job_id}", timeout=30)
+        if resposta_job.status_code != 200:
+            # Job sumiu (estado apagado ou job podado) ou o backend falhou
+            job = {"status": "error", "error": f"Não foi possível acompanhar o job ({resposta_job.status_code}): {resposta_job.text}"}
+            break
+        job = resposta_job.json()
+        if job.get("status") in ("done", "error"):
+            break
+        total = job.get("total") or 0
+        feitos = job.get("done") or 0
+        texto = f"Etapa: {job.get('stage') or '...'} ({feitos}/{total or '?'})"
+        if job.get("eta_seconds") is not None:
+            texto += f" - ETA {job['eta_seconds']:.0f}s"
+        progresso.progress(min(feitos / total, 1.0) if total else 0.0, text=texto)
+        time.sleep(1)
+    progresso.empty()
+    return job
+
+
+class RespostaJob:
+    """Resposta final de uma importação que seguiu em background: mesmo formato da resposta direta."""
+
+    def __init__(self, status_code, corpo):
+        self.status_code = status_code
+        self._corpo = corpo
+        self.text = json.dumps(corpo, ensure_ascii=False)
+
+    def json(self):
+        return self._corpo
+
+
+def aguardar_importacao(response):
+    """Se o /import-jira respondeu 202 (importação longa), acompanha o job e devolve o resultado final."""
+    if response.status_code != 202:
+        return response
+    job = acompanhar_job(response.json().get("job_id"), "Importação em andamento...")
+    if job.get("status") == "done":
+        return RespostaJob(200, job.get("result") or {})
+    return RespostaJob(500, {"error": job.get("error") or "Erro na importação"})
+
+
 # Sidebar para controles
 with st.sidebar:
     st.header("Controles do Sistema")
@@ -46,7 +92,16 @@ with st.sidebar:
             try:
                 files = {"file": (uploaded_file.name, uploaded_file.getvalue())}
                 response = requests.post("http://localhost:5000/upload-jira", files=files, timeout=120)
-                if response.status_code == 200:
+                erro = None
+                if response.status_code == 202:
+                    # A indexação roda em background no backend; acompanha o job até terminar
+                    job_id = response.json().get("job_id")
+                    job = acompanhar_job(job_id, "Indexação iniciada...")
+                    if job.get("status") == "error":
+                        erro = job.get("error") or "Erro na indexação"
+                else:
+                    erro = response.text
+                if erro is None:
                     st.success("Dados processados e indexados com sucesso!")
                     # Limpar estado após upload
                     if 'last_chunks' in st.session_state:
@@ -56,7 +111,7 @@ with st.sidebar:
                     if 'analysis_result' in st.session_state:
                         del st.session_state['analysis_result']
                 else:
-                    st.error(f"Erro no processamento: {response.text}")
+                    st.error(f"Erro no processamento: {erro}")
             except Exception as e:
                 st.error(f"Erro de conexão: {e}")
 
@@ -124,7 +179,8 @@ with tab1:
                         "http://localhost:5000/chatgpt-rank",
                         json={
                             "question": st.session_state.get('query_input', ''),
-                            "chunks": chunks
+                            "chunks": chunks,
+                            "mode": st.session_state.get('query_mode')
                         },
                         timeout=60
                     )
@@ -239,6 +295,7 @@ with tab3:
                             },
                             timeout=120
                         )
+                        response = aguardar_importacao(response)
                         
                         if response.status_code == 200:
                             result = response.json()
@@ -317,6 +374,7 @@ with tab3:
                             },
                             timeout=120
                         )
+                        response = aguardar_importacao(response)
                         
                         if response.status_code == 200:
                             result = response.json()
@@ -394,6 +452,7 @@ with tab3:
                             },
                             timeout=120
                         )
+                        response = aguardar_importacao(response)
                         
                         if response.status_code == 200:
                             result = response.json()
@@ -484,6 +543,7 @@ with tab3:
                             },
                             timeout=120
                         )
+                        response = aguardar_importacao(response)
                         
                         if response.status_code == 200:
                             result = response.json()